@@ -0,0 +1,22 @@
+"""
+ASGI config for WeChatTicket project.
+
+It exposes the ASGI callable as a module-level variable named ``application``, e.g. for
+``uvicorn WeChatTicket.asgi:application``. WeChat messages are served by the async endpoint
+of CustomWeChatView, every other path by the WSGI application in the same thread pool.
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "WeChatTicket.settings")
+
+wsgi_application = get_wsgi_application()
+
+from codex.asgi import AsgiRouter, WsgiBridge
+from wechat.views import CustomWeChatView
+
+application = AsgiRouter([
+    (r'^/wechat/?$', CustomWeChatView.as_asgi()),
+], fallback=WsgiBridge(wsgi_application, CustomWeChatView.executor))
@@ -44,6 +44,43 @@ WECHAT_TOKEN = CONFIGS['WECHAT_TOKEN']
 WECHAT_APPID = CONFIGS['WECHAT_APPID']
 WECHAT_SECRET = CONFIGS['WECHAT_SECRET']
 
+# WeChat API server, keep-alive connections kept to it per process and seconds to wait for each call
+WECHAT_API_ROOT = CONFIGS.get('WECHAT_API_ROOT', 'https://api.weixin.qq.com')
+WECHAT_API_CONNECTIONS = CONFIGS.get('WECHAT_API_CONNECTIONS', 10)
+WECHAT_API_TIMEOUT = CONFIGS.get('WECHAT_API_TIMEOUT', 5)
+
+# Custom menu updates within this many seconds are pushed to WeChat once, 0 pushes every update at once
+WECHAT_MENU_DEBOUNCE = CONFIGS.get('WECHAT_MENU_DEBOUNCE', 2)
+
+# Access token shared by all processes on the host, keep it private
+WECHAT_TOKEN_FILE = CONFIGS.get('WECHAT_TOKEN_FILE', os.path.join(BASE_DIR, 'cache', 'wechat_access_token.json'))
+
+# Snap-up requests of one activity arriving within this window (in seconds) are booked in one transaction,
+# 0 books every request on its own
+BOOKING_BATCH_WINDOW = CONFIGS.get('BOOKING_BATCH_WINDOW', 0)
+
+# Seconds between writes of the check-ins accepted by an activity in gate mode (wechat/gate.py),
+# 0 writes every check-in at once
+GATE_FLUSH_INTERVAL = CONFIGS.get('GATE_FLUSH_INTERVAL', 1)
+
+# Render passive replies with templates/text.xml and templates/news.xml instead of the built-in serializer,
+# for deployments customizing these templates
+WECHAT_REPLY_TEMPLATES = CONFIGS.get('WECHAT_REPLY_TEMPLATES', False)
+
+# Seconds a handler has to reply to a WeChat message before the reply is sent as a customer service message,
+# WeChat gives up after 5 seconds and retries. 0 handles every message in the request thread without a budget
+WECHAT_REPLY_BUDGET = CONFIGS.get('WECHAT_REPLY_BUDGET', 4.5)
+
+# Seconds WeChat messages are remembered in CACHES so that retries get the reply of the original message instead
+# of handling it again. Messages are claimed with cache.add, so CACHES must be shared by all workers and add
+# atomically: memcached, redis or the database. With the default filebased cache two workers receiving a retry at
+# once may both handle it, and with locmem only retries reaching the same process are caught. 0 handles every retry
+WECHAT_DEDUP_WINDOW = CONFIGS.get('WECHAT_DEDUP_WINDOW', 60)
+
+# Threads running handlers for the reply budget and the ASGI endpoint (WeChatTicket/asgi.py),
+# i.e. the most database connections they open
+ASYNC_WORKERS = CONFIGS.get('ASYNC_WORKERS', 32)
+
 ALLOWED_HOSTS = ['*']
 
 
@@ -121,6 +158,17 @@ DATABASES = {
 }
 
 
+# Cache shared by the worker processes on a host, use memcached when running on several hosts
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': CONFIGS.get('CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': CONFIGS.get('CACHE_LOCATION', os.path.join(BASE_DIR, 'cache')),
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
@@ -1,8 +1,16 @@
+from unittest import mock
+
+from django.core.cache import cache
 from django.test import TestCase, Client
 from django.contrib.auth.models import User
-from wechat.models import Activity
+from wechat.models import Activity, Ticket
 from codex.baseerror import *
+from wechat import manifest
+from wechat.gate import Gate
+from wechat.views import CustomWeChatView
+from wechat.wrapper import WeChatError
 import dateutil
+import gzip
 import json
 
 backendAPIs = [
@@ -18,6 +26,11 @@ backendAPIs = [
     ['/api/a/activity/menu', 'get'],
     ['/api/a/activity/menu', 'post'],
     ['/api/a/activity/checkin', 'post'],
+    ['/api/a/activity/checkin/batch', 'post'],
+    ['/api/a/activity/gate', 'get'],
+    ['/api/a/activity/gate', 'post'],
+    ['/api/a/activity/manifest', 'get'],
+    ['/api/a/activity/export', 'get'],
 ]
 
 needAuthorizationAPIs = backendAPIs[1:]
@@ -93,6 +106,8 @@ class BackendAPITest(TestCase):
         content = self.checkURL(c, '/api/a/activity/create', 'post', data, 0)
         id = content['data']
         data['id'] = id
+        self.assertEqual(Ticket.objects.filter(activity_id=id, status=Ticket.STATUS_UNCLAIMED).count(), 100,
+                         'publishing should allocate the ticket pool')
         # modify it
         data['name'] = 'haha'
         self.checkURL(c, '/api/a/activity/detail', 'post', data, 0)
@@ -110,3 +125,253 @@ class BackendAPITest(TestCase):
         self.checkURL(c, '/api/a/activity/delete', 'post', {'id': id}, 0)
 
         self.logout(c)
+
+    def test_menu(self):
+        cache.clear()
+        c = Client()
+        self.login(c)
+        future = dateutil.parser.parse('2100-01-01 00:00:00 UTC')
+        activities = [Activity.objects.create(
+            name='menu%d' % i, key='menu%d' % i, description='', start_time=future, end_time=future, place='',
+            book_start=future, book_end=future, total_tickets=1, status=Activity.STATUS_PUBLISHED, pic_url='',
+            remain_tickets=1,
+        ) for i in range(3)]
+        lib = CustomWeChatView.lib
+        with mock.patch.object(CustomWeChatView.menu_sync, 'delay', 0), \
+                mock.patch.object(lib, 'set_wechat_menu') as set_menu, \
+                mock.patch.object(lib, 'get_wechat_menu', return_value=[]) as get_menu:
+            self.checkURL(c, '/api/a/activity/menu', 'post', [activities[2].id, activities[0].id], 0)
+            self.checkURL(c, '/api/a/activity/menu', 'post', [activities[2].id, activities[0].id], 0)
+            self.assertEqual(set_menu.call_count, 1, 'an unchanged menu should not be pushed again')
+            self.assertEqual([x['name'] for x in CustomWeChatView.get_book_btn()['sub_button']], ['menu2', 'menu0'])
+
+            content = self.checkURL(c, '/api/a/activity/menu', 'get', None, 0)
+            get_menu.assert_not_called()
+            self.assertEqual({x['name']: x['menuIndex'] for x in content['data']}, {'menu0': 2, 'menu1': 0, 'menu2': 1})
+
+            self.checkURL(c, '/api/a/activity/menu', 'post', [activities[1].id, -1], LogicError('').code)
+
+        with mock.patch.object(lib, 'set_wechat_menu', side_effect=WeChatError(40016, 'invalid button size')):
+            with mock.patch.object(CustomWeChatView.menu_sync, 'delay', 0):
+                self.checkURL(c, '/api/a/activity/menu', 'post', [activities[1].id], -1)
+            self.checkURL(c, '/api/a/activity/menu', 'post', [activities[0].id], 0)
+            CustomWeChatView.menu_sync.flush_quietly()  # what the debounce timer runs
+        content = self.checkURL(c, '/api/a/activity/menu', 'get', None, LogicError('').code)
+        self.assertIn('invalid button size', content['msg'])
+        self.checkURL(c, '/api/a/activity/menu', 'get', None, 0)
+        self.logout(c)
+
+    def test_detail_statistics(self):
+        c = Client()
+        self.login(c)
+        now = dateutil.parser.parse('2018-10-16 14:59:51 UTC')
+        activities = [Activity.objects.create(
+            name='stats%d' % i, key='stats%d' % i, description='', start_time=now, end_time=now, place='',
+            book_start=now, book_end=now, total_tickets=10, status=Activity.STATUS_PUBLISHED, pic_url='',
+            remain_tickets=10,
+        ) for i in range(2)]
+        tickets = [Ticket.create_ticket(str(i), activities[0]) for i in range(3)]
+        Ticket.create_ticket('3', activities[1])
+        self.checkURL(c, '/api/a/activity/checkin', 'post', {'actId': activities[0].id, 'ticket': tickets[0].unique_id}, 0)
+        Ticket.cancel_ticket(tickets[1], activities[0])
+
+        data = self.checkURL(c, '/api/a/activity/detail', 'get', {'id': activities[0].id}, 0)['data']
+        self.assertEqual((data['bookedTickets'], data['usedTickets']), (2, 1))
+        data = self.checkURL(c, '/api/a/activity/detail', 'get', {'id': activities[1].id}, 0)['data']
+        self.assertEqual((data['bookedTickets'], data['usedTickets']), (1, 0), 'counts are per activity')
+        self.logout(c)
+
+    def test_checkin_batch(self):
+        c = Client()
+        self.login(c)
+        now = dateutil.parser.parse('2018-10-16 14:59:51 UTC')
+        activities = [Activity.objects.create(
+            name='gate%d' % i, key='gate%d' % i, description='', start_time=now, end_time=now, place='',
+            book_start=now, book_end=now, total_tickets=10, status=Activity.STATUS_PUBLISHED, pic_url='',
+            remain_tickets=10,
+        ) for i in range(2)]
+        tickets = [Ticket.create_ticket(str(i), activities[0]) for i in range(4)]
+        other = Ticket.create_ticket('0', activities[1])
+        Ticket.cancel_ticket(tickets[2], activities[0])
+        scans = [
+            {'ticket': tickets[0].unique_id, 'time': int(now.timestamp())},
+            {'studentId': '1'},
+            {'ticket': tickets[0].unique_id},
+            {'ticket': tickets[2].unique_id},
+            {'ticket': other.unique_id},
+            {'studentId': '9'},
+        ]
+        data = self.checkURL(c, '/api/a/activity/checkin/batch', 'post',
+                             {'actId': activities[0].id, 'scans': scans}, 0)['data']
+        self.assertEqual([x['result'] for x in data], ['accepted', 'accepted', 'used', 'rejected', 'rejected', 'noticket'])
+        self.assertEqual(data[1]['ticket'], tickets[1].unique_id)
+        self.assertEqual(Ticket.objects.get(id=tickets[0].id).used_time, now)
+        self.assertEqual(Ticket.objects.get(id=other.id).status, Ticket.STATUS_VALID, 'scoped to the activity')
+        data = self.checkURL(c, '/api/a/activity/detail', 'get', {'id': activities[0].id}, 0)['data']
+        self.assertEqual(data['usedTickets'], 2)
+
+        data = self.checkURL(c, '/api/a/activity/checkin/batch', 'post',
+                             {'actId': activities[0].id, 'scans': [{'studentId': '1'}, {'studentId': '3'}]}, 0)['data']
+        self.assertEqual([x['result'] for x in data], ['used', 'accepted'])
+        data = self.checkURL(c, '/api/a/activity/checkin/batch', 'post', {'actId': activities[0].id, 'scans': [
+            {'ticket': tickets[0].issue_token()}, {'ticket': other.issue_token()}, {'ticket': 'x:y'},
+        ]}, 0)['data']
+        self.assertEqual([x['result'] for x in data], ['used', 'rejected', 'rejected'])
+        self.checkURL(c, '/api/a/activity/checkin/batch', 'post',
+                      {'actId': activities[0].id, 'scans': [{'ticket': 'x', 'studentId': '1'}]}, InputError('').code)
+        self.logout(c)
+
+    def test_gate(self):
+        cache.clear()
+        c = Client()
+        self.login(c)
+        now = dateutil.parser.parse('2018-10-16 14:59:51 UTC')
+        activities = [Activity.objects.create(
+            name='door%d' % i, key='door%d' % i, description='', start_time=now, end_time=now, place='',
+            book_start=now, book_end=now, total_tickets=10, status=Activity.STATUS_PUBLISHED, pic_url='',
+            remain_tickets=10,
+        ) for i in range(2)]
+        tickets = [Ticket.create_ticket(str(i), activities[0]) for i in range(2)]
+        spare = Ticket.create_ticket('9', activities[0])
+        Ticket.create_ticket('5', activities[1])
+        checkin = '/api/a/activity/checkin'
+
+        data = self.checkURL(c, '/api/a/activity/gate', 'post', {'actId': activities[0].id, 'open': 1}, 0)['data']
+        self.assertEqual((data['tickets'], data['used']), (3, 0))
+        self.assertTrue(self.checkURL(c, '/api/a/activity/gate', 'get', {'actId': activities[0].id}, 0)['data']['open'])
+        late = Ticket.create_ticket('2', activities[0])
+        data = self.checkURL(c, checkin, 'post', {'actId': activities[0].id, 'studentId': '2'}, 0)['data']
+        self.assertEqual(data['ticket'], late.unique_id, 'tickets booked after opening are looked up')
+        self.checkURL(c, checkin, 'post', {'actId': activities[0].id, 'ticket': tickets[0].unique_id}, 0)
+        content = self.checkURL(c, checkin, 'post', {'actId': activities[0].id, 'ticket': tickets[0].unique_id},
+                                LogicError('').code)
+        self.assertEqual(content['msg'], 'used')
+        content = self.checkURL(c, checkin, 'post', {'actId': activities[0].id, 'studentId': '5'}, LogicError('').code)
+        self.assertEqual(content['msg'], 'noticket', 'student ids are scoped to the activity')
+        data = self.checkURL(c, checkin, 'post', {'actId': activities[0].id, 'ticket': tickets[1].issue_token()}, 0)['data']
+        self.assertEqual(data['ticket'], tickets[1].unique_id)
+        self.assertEqual(Ticket.objects.get(id=tickets[0].id).status, Ticket.STATUS_USED)
+        self.assertEqual(Ticket.objects.get(id=late.id).status, Ticket.STATUS_USED)
+
+        Ticket.cancel_ticket(spare, activities[0])
+        content = self.checkURL(c, checkin, 'post', {'actId': activities[0].id, 'ticket': spare.unique_id},
+                                LogicError('').code)
+        self.assertEqual(content['msg'], 'rejected', 'tickets cancelled after opening are rejected')
+        content = self.checkURL(c, checkin, 'post', {'actId': activities[0].id, 'studentId': '9'}, LogicError('').code)
+        self.assertEqual(content['msg'], 'noticket')
+
+        gate = Gate(activities[1], flush_interval=1).load()  # synced by the flusher thread, not by check()
+        other = Ticket.objects.get(activity=activities[1])
+        Ticket.cancel_ticket(other, activities[1])
+        self.assertEqual(gate.sync(), 1)
+        self.assertEqual(gate.check(other.unique_id)[2], 'rejected')
+
+        data = self.checkURL(c, '/api/a/activity/gate', 'post', {'actId': activities[0].id, 'open': 'false'}, 0)['data']
+        self.assertFalse(data['open'])
+        self.assertFalse(self.checkURL(c, '/api/a/activity/gate', 'get', {'actId': activities[0].id}, 0)['data']['open'])
+        self.checkURL(c, '/api/a/activity/gate', 'post', {'actId': activities[0].id, 'open': '1'}, 0)
+        self.checkURL(c, '/api/a/activity/gate', 'post', {'actId': activities[0].id, 'open': '0'}, 0)
+        self.assertFalse(self.checkURL(c, '/api/a/activity/gate', 'get', {'actId': activities[0].id}, 0)['data']['open'])
+        Ticket.create_ticket('3', activities[0])
+        self.checkURL(c, checkin, 'post', {'actId': activities[0].id, 'studentId': '3'}, 0)
+        self.checkURL(c, checkin, 'post', {'actId': activities[0].id, 'studentId': '5'}, -1)
+        self.checkURL(c, checkin, 'post', {'actId': activities[0].id, 'ticket': tickets[1].issue_token()}, -1)
+        self.logout(c)
+
+    def test_manifest(self):
+        c = Client()
+        self.login(c)
+        now = dateutil.parser.parse('2018-10-16 14:59:51 UTC')
+        activity = Activity.objects.create(
+            name='offline', key='offline', description='', start_time=now, end_time=now, place='',
+            book_start=now, book_end=now, total_tickets=100, status=Activity.STATUS_PUBLISHED, pic_url='',
+            remain_tickets=100,
+        )
+        tickets = [Ticket.create_ticket(str(i), activity) for i in range(50)]
+        Ticket.cancel_ticket(tickets[0], activity)
+        self.checkURL(c, '/api/a/activity/checkin', 'post', {'actId': activity.id, 'ticket': tickets[1].unique_id}, 0)
+
+        response = c.get('/api/a/activity/manifest', {'actId': activity.id})
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        full = manifest.Manifest(response.content)
+        self.assertEqual((full.kind, full.activity_id, len(full)), (manifest.KIND_FULL, activity.id, 49))
+        self.assertEqual(full.version, int(response['X-Manifest-Version']))
+        hashes = [full[i][0] for i in range(len(full))]
+        self.assertEqual(hashes, sorted(hashes))
+        self.assertEqual(full.lookup(tickets[2].issue_token()), Ticket.STATUS_VALID, 'keyed by what the QR code holds')
+        self.assertEqual(full.lookup(tickets[1].issue_token()), Ticket.STATUS_USED)
+        self.assertIsNone(full.lookup(tickets[0].issue_token()), 'cancelled tickets are left out')
+        self.assertIsNone(full.lookup(tickets[2].unique_id))
+        self.assertIsNone(full.lookup('0.%d.x:y' % (activity.id, )))
+
+        with mock.patch.object(manifest, 'delta_overlap', 0):
+            Ticket.cancel_ticket(tickets[3], activity)
+            Ticket.objects.exclude(id=tickets[3].id).update(modified_time=now)
+            response = c.get('/api/a/activity/manifest', {'actId': activity.id, 'since': full.version})
+        delta = manifest.Manifest(response.content)
+        self.assertEqual((delta.kind, delta.since, len(delta)), (manifest.KIND_DELTA, full.version, 1))
+        self.assertEqual(delta.lookup(tickets[3].issue_token()), Ticket.STATUS_CANCELLED)
+        self.checkURL(c, '/api/a/activity/manifest', 'get', {'actId': activity.id, 'since': 'x'}, InputError('').code)
+        self.logout(c)
+
+    def test_export(self):
+        c = Client()
+        self.login(c)
+        now = dateutil.parser.parse('2018-10-16 14:59:51 UTC')
+        activity = Activity.objects.create(
+            name='export', key='export', description='', start_time=now, end_time=now, place='',
+            book_start=now, book_end=now, total_tickets=100, status=Activity.STATUS_PUBLISHED, pic_url='',
+            remain_tickets=100,
+        )
+        tickets = [Ticket.create_ticket('2016%06d' % i, activity) for i in range(25)]
+        Ticket.cancel_ticket(tickets[0], activity)
+
+        with mock.patch('adminpage.views.ActivityExport.chunk_size', 10):
+            response = c.get('/api/a/activity/export', {'actId': activity.id})
+            self.assertTrue(response.streaming)
+            lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'student_id,unique_id,status,used_time,modified_time')
+        self.assertEqual([line.split(',')[1] for line in lines[1:]], [t.unique_id for t in tickets])
+
+        response = c.get('/api/a/activity/export', {'actId': activity.id, 'format': 'jsonl', 'status': 1, 'gzip': 1})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        rows = [json.loads(line) for line in gzip.decompress(b''.join(response.streaming_content)).splitlines()]
+        self.assertEqual([x['student_id'] for x in rows], [t.student_id for t in tickets[1:]])
+
+        response = c.get('/api/a/activity/export', {'actId': activity.id, 'status': 2})
+        self.assertEqual(b''.join(response.streaming_content).decode().splitlines(),
+                         ['student_id,unique_id,status,used_time,modified_time'])
+        self.checkURL(c, '/api/a/activity/export', 'get', {'actId': activity.id, 'format': 'xml'}, InputError('').code)
+        self.logout(c)
+
+    def test_activity_list(self):
+        cache.clear()
+        c = Client()
+        self.login(c)
+        when = dateutil.parser.parse('2018-10-16 14:59:51 UTC')
+        for i in range(25):
+            Activity.objects.create(
+                name='list%d' % i, key='list%d' % i, description='', start_time=when, end_time=when, place='',
+                book_start=when, book_end=when, total_tickets=1, pic_url='', remain_tickets=1,
+                status=Activity.STATUS_PUBLISHED if i % 5 else Activity.STATUS_SAVED,
+            )
+        data = self.checkURL(c, '/api/a/activity/list', 'get', None, 0)['data']
+        self.assertEqual((data['total'], data['page'], len(data['activities'])), (25, 1, 20))
+        self.assertEqual(data['activities'][0]['name'], 'list24', 'newest first')
+        data = self.checkURL(c, '/api/a/activity/list', 'get', {'page': 2}, 0)['data']
+        self.assertEqual([x['name'] for x in data['activities']], ['list%d' % i for i in range(4, -1, -1)])
+        data = self.checkURL(c, '/api/a/activity/list', 'get', {'status': Activity.STATUS_SAVED}, 0)['data']
+        self.assertEqual(data['total'], 5)
+        data = self.checkURL(c, '/api/a/activity/list', 'get', {'timeFrom': int(when.timestamp()) + 1}, 0)['data']
+        self.assertEqual(data['total'], 0)
+        self.checkURL(c, '/api/a/activity/list', 'get', {'page': 'x'}, InputError('').code)
+
+        response = c.get('/api/a/activity/list')
+        etag = response['ETag']
+        self.assertEqual(c.get('/api/a/activity/list', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(c.get('/api/a/activity/list', {'page': 2}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        Activity.objects.filter(name='list0').first().save()
+        response = c.get('/api/a/activity/list', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200, 'changed activities should change the ETag')
+        self.assertNotEqual(response['ETag'], etag)
+        self.logout(c)
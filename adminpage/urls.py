@@ -17,4 +17,8 @@ urlpatterns = [
     url(r'^activity/detail/?$', ActivityDetail.as_view()),
     url(r'^activity/menu/?$', ActivityMenu.as_view()),
     url(r'^activity/checkin/?$', ActivityCheckin.as_view()),
+    url(r'^activity/checkin/batch/?$', ActivityCheckinBatch.as_view()),
+    url(r'^activity/gate/?$', ActivityGate.as_view()),
+    url(r'^activity/manifest/?$', ActivityManifest.as_view()),
+    url(r'^activity/export/?$', ActivityExport.as_view()),
 ]
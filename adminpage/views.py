@@ -2,15 +2,22 @@ from django.shortcuts import render
 from django.db import transaction
 from django.utils import timezone
 from django.contrib.auth import logout, authenticate, login
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
 from codex.baseview import APIView
-from wechat.models import Activity, Ticket
+from wechat.models import Activity, Ticket, ActivityStatistics
 from codex.baseerror import ValidateError, InputError, LogicError
 from dateutil.parser import parse as datetime_parse_func
 from WeChatTicket import settings
 from wechat.views import CustomWeChatView
+from wechat.gate import gates
+from wechat import manifest
 import urllib.parse
 import datetime
+import csv
+import io
+import zlib
 import hashlib
+import json
 import time
 import os
 
@@ -48,22 +55,67 @@ class UserLogout(APIView):
 
 
 class ActivityList(APIView):
+    page_size = 20
+    max_page_size = 100
+
+    # responses are tagged with the list version and this period, so that currentTime is at most this old
+    etag_period = 60
+
+    def get_int(self, key, default=None):
+        value = self.input.get(key)
+        if value in (None, ''):
+            return default
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise InputError('Field "%s" should be an integer' % (key, ))
+
     @require_logged_in
     def get(self):
-        data = list(Activity.objects.all())
-        return [{
-            'id': x.id,
-            'name': x.name,
-            'description': x.description,
-            'startTime': int(x.start_time.timestamp()),
-            'endTime': int(x.end_time.timestamp()),
-            'place': x.place,
-            'bookStart': int(x.book_start.timestamp()),
-            'bookEnd': int(x.book_end.timestamp()),
-            'currentTime': int(time.time()),
-            'status': x.status
+        page = max(self.get_int('page', 1), 1)
+        page_size = min(max(self.get_int('pageSize', self.page_size), 1), self.max_page_size)
+        status = self.input.get('status')
+        time_from = self.get_int('timeFrom')
+        time_to = self.get_int('timeTo')
+
+        now = int(time.time())
+        etag = hashlib.md5(json.dumps([
+            Activity.get_list_version(), now // self.etag_period, page, page_size, status, time_from, time_to
+        ]).encode()).hexdigest()
+        if self.not_modified(etag):
+            return HttpResponseNotModified()
+
+        activities = Activity.objects.all()
+        if status not in (None, ''):
+            try:
+                activities = activities.filter(status__in=[int(x) for x in str(status).split(',')])
+            except ValueError:
+                raise InputError('Field "status" should be integers separated by commas')
+        if time_from is not None:
+            activities = activities.filter(end_time__gte=datetime.datetime.fromtimestamp(time_from, timezone.utc))
+        if time_to is not None:
+            activities = activities.filter(start_time__lte=datetime.datetime.fromtimestamp(time_to, timezone.utc))
+        total = activities.count()
+        rows = activities.order_by('-id').values(
+            'id', 'name', 'description', 'start_time', 'end_time', 'place', 'book_start', 'book_end', 'status'
+        )[(page - 1) * page_size: page * page_size]
+        return {
+            'total': total,
+            'page': page,
+            'pageSize': page_size,
+            'activities': [{
+                'id': x['id'],
+                'name': x['name'],
+                'description': x['description'],
+                'startTime': int(x['start_time'].timestamp()),
+                'endTime': int(x['end_time'].timestamp()),
+                'place': x['place'],
+                'bookStart': int(x['book_start'].timestamp()),
+                'bookEnd': int(x['book_end'].timestamp()),
+                'currentTime': now,
+                'status': x['status']
+            } for x in rows],
         }
-            for x in data]
 
 
 class ActivityDelete(APIView):
@@ -86,9 +138,12 @@ class ActivityCreate(APIView):
                      description=self.input['description'], pic_url=self.input['picUrl'],
                      start_time=self.input['startTime'], end_time=self.input['endTime'],
                      book_start=self.input['bookStart'], book_end=self.input['bookEnd'],
-                     total_tickets=self.input['totalTickets'], status=self.input['status'])
+                     total_tickets=self.input['totalTickets'], status=self.input['status'],
+                     book_mode=self.input.get('bookMode', Activity.BOOK_MODE_FIRST_COME))
         q.remain_tickets = q.total_tickets
         q.save()
+        if int(q.status) == Activity.STATUS_PUBLISHED:
+            Ticket.allocate_pool(q)
         return q.id
 
 
@@ -109,6 +164,7 @@ class ActivityDetail(APIView):
     def get(self):
         self.check_input('id')
         x = Activity.objects.get(id=self.input['id'])
+        stats = ActivityStatistics.get_for(x.id)
         return {
             'name': x.name,
             'key': x.key,
@@ -120,10 +176,11 @@ class ActivityDetail(APIView):
             'bookEnd': int(x.book_end.timestamp()),
             'totalTickets': x.total_tickets,
             'picUrl': x.pic_url,
-            'bookedTickets': x.total_tickets - x.remain_tickets,
-            'usedTickets': len([x for x in Ticket.objects.all() if x.status == Ticket.STATUS_USED]),
+            'bookedTickets': stats['booked'] - stats['cancelled'],
+            'usedTickets': stats['used'],
             'currentTime': int(time.time()),
-            'status': x.status
+            'status': x.status,
+            'bookMode': x.book_mode,
         }
 
     @require_logged_in
@@ -142,13 +199,19 @@ class ActivityDetail(APIView):
         x.book_end = datetime_parse_func(self.input['bookEnd'])
         x.total_tickets = self.input['totalTickets']
         x.status = self.input['status']
+        x.book_mode = self.input.get('bookMode', x.book_mode)
         x.save()
+        if int(x.status) == Activity.STATUS_PUBLISHED:
+            Ticket.allocate_pool(x)
 
 
 class ActivityMenu(APIView):
     @require_logged_in
     def get(self):
-        buttons = CustomWeChatView.lib.get_wechat_menu()
+        error = CustomWeChatView.menu_sync.pop_error()
+        if error is not None:
+            raise LogicError('Failed to push the menu to WeChat: %s' % (error, ))
+        buttons = CustomWeChatView.menu_sync.current().get('button', [])
         if not buttons:
             raise LogicError("Empty WeChat list.")
         names = [x['name'] for x in buttons]
@@ -165,8 +228,26 @@ class ActivityMenu(APIView):
 
     @require_logged_in
     def post(self):
-        ids = self.input
-        CustomWeChatView.update_menu([Activity.objects.get(id=x) for x in ids])
+        ids = [int(x) for x in self.input]
+        activities = Activity.objects.in_bulk(ids)
+        missing = [x for x in ids if x not in activities]
+        if missing:
+            raise LogicError('Activity %s not found' % ', '.join(map(str, missing)))
+        error = CustomWeChatView.menu_sync.pop_error()
+        CustomWeChatView.update_menu([activities[x] for x in ids])  # pushed after WECHAT_MENU_DEBOUNCE seconds
+        if error is not None:
+            raise LogicError('Failed to push the menu to WeChat: %s, pushing it again' % (error, ))
+
+
+def token_student_id(activity_id, token):
+    """
+    A ticket token scanned at the door stands for the valid ticket of its student in the activity
+    :return: the student id, None if the token is forged or of another activity
+    """
+    verified = Ticket.verify_token(token)
+    if verified is None or verified[1] != activity_id:
+        return None
+    return verified[2]
 
 
 class ActivityCheckin(APIView):
@@ -176,17 +257,208 @@ class ActivityCheckin(APIView):
         if ('ticket' in self.input and 'studentId' in self.input) or ('ticket' not in self.input and 'studentId' not in self.input):
             raise InputError(
                 "Ticket and student ID, you can provide and only provide one.")
+        try:
+            activity_id = int(self.input['actId'])
+        except (TypeError, ValueError):
+            raise InputError('Field "actId" should be an integer')
+        unique_id, student_id = self.input.get('ticket'), self.input.get('studentId')
+        if Ticket.is_token(unique_id):
+            student_id = token_student_id(activity_id, unique_id)
+            if student_id is None:
+                raise LogicError('rejected')
+            unique_id = None
+        gate = gates.get(activity_id)
+        if gate is not None:
+            unique_id, student_id, result = gate.check(unique_id, student_id)
+            if result != 'accepted':
+                raise LogicError(result)  # a key of ticket_msg_map of the check-in page
+            return {
+                'ticket': unique_id,
+                'studentId': student_id
+            }
         with transaction.atomic():
-            if 'ticket' in self.input:
-                x = Ticket.objects.select_for_update().get(unique_id=self.input['ticket'])
+            tickets = Ticket.objects.select_for_update().filter(activity_id=activity_id)
+            if unique_id is not None:
+                x = tickets.get(unique_id=unique_id)
             else:
-                x = Ticket.objects.select_for_update().get(student_id=self.input['studentId'])
+                found = sorted(tickets.filter(student_id=student_id).exclude(status=Ticket.STATUS_UNCLAIMED),
+                               key=lambda t: t.status != Ticket.STATUS_VALID)
+                if not found:
+                    raise Ticket.DoesNotExist('Ticket matching query does not exist.')
+                x = found[0]
             if x.status != Ticket.STATUS_VALID:
                 raise Exception('ticket already used' if x.status ==
                                 Ticket.STATUS_USED else 'ticket already cancelled')
             x.status = Ticket.STATUS_USED
+            x.used_time = timezone.now()
             x.save()
+            ActivityStatistics.record(x.activity_id, used=1)
         return {
             'ticket': x.unique_id,
             'studentId': x.student_id
         }
+
+
+class ActivityCheckinBatch(APIView):
+    """
+    Scans queued by a gate scanner while offline, checked in at once:
+    {"actId": 1, "scans": [{"ticket": "..." or "studentId": "...", "time": unix seconds of the scan}, ...]}
+    """
+    max_scans = 1000
+
+    @require_logged_in
+    def post(self):
+        self.check_input('actId', 'scans')
+        scans = self.input['scans']
+        if not isinstance(scans, list) or len(scans) > self.max_scans:
+            raise InputError('Field "scans" should be a list of at most %d scans' % (self.max_scans, ))
+        try:
+            activity = Activity.objects.get(id=self.input['actId'])
+        except (Activity.DoesNotExist, TypeError, ValueError):
+            raise LogicError('Activity not found')
+        now = timezone.now()
+        batch = list()
+        for scan in scans:
+            if not isinstance(scan, dict) or ('ticket' in scan) == ('studentId' in scan):
+                raise InputError('Each scan should have one of ticket and student ID')
+            try:
+                scanned = datetime.datetime.fromtimestamp(float(scan['time']), timezone.utc) \
+                    if scan.get('time') not in (None, '') else now
+            except (TypeError, ValueError, OverflowError):
+                raise InputError('Field "time" of a scan should be unix seconds')
+            unique_id, student_id = scan.get('ticket'), scan.get('studentId')
+            if Ticket.is_token(unique_id):
+                student_id = token_student_id(activity.id, unique_id)
+                if student_id is not None:
+                    unique_id = None  # a forged token is left as an unknown ticket, i.e. rejected
+            batch.append((unique_id, student_id, min(scanned, now)))
+        return [{
+            'ticket': unique_id,
+            'studentId': student_id,
+            'result': result,
+        } for unique_id, student_id, result in Ticket.check_in(activity, batch)]
+
+
+class ActivityGate(APIView):
+    """
+    Gate mode of an activity: check-ins are validated in memory and written in the background
+    """
+
+    @require_logged_in
+    def get(self):
+        self.check_input('actId')
+        return {'open': gates.is_open(self.input['actId'])}
+
+    @require_logged_in
+    def post(self):
+        self.check_input('actId', 'open')
+        try:
+            activity = Activity.objects.get(id=self.input['actId'])
+        except (Activity.DoesNotExist, TypeError, ValueError):
+            raise LogicError('Activity not found')
+        if str(self.input['open']).lower() in ('1', 'true'):
+            gate = gates.open(activity)
+            return {'open': True, 'tickets': len(gate.tickets), 'used': len(gate.used)}
+        gates.close(activity.id)
+        return {'open': False}
+
+
+class ActivityManifest(APIView):
+    """
+    Binary manifest of the tickets of an activity for offline gate devices (wechat/manifest.py),
+    a delta after `since`, the X-Manifest-Version of the manifest the device has, if given
+    """
+
+    @require_logged_in
+    def get(self):
+        self.check_input('actId')
+        try:
+            activity = Activity.objects.get(id=self.input['actId'])
+        except (Activity.DoesNotExist, TypeError, ValueError):
+            raise LogicError('Activity not found')
+        since = self.input.get('since')
+        if since not in (None, ''):
+            try:
+                since = int(since)
+            except (TypeError, ValueError):
+                raise InputError('Field "since" should be a manifest version')
+        else:
+            since = None
+        data, version = manifest.build(activity.id, since)
+        response = HttpResponse(data, content_type='application/octet-stream')
+        response['X-Manifest-Version'] = str(version)
+        response['Content-Disposition'] = 'attachment; filename="manifest-%d-%d.bin"' % (activity.id, version)
+        return response
+
+
+class ActivityExport(APIView):
+    """
+    Tickets of an activity as CSV or JSON lines, streamed in chunks read by id so that memory stays flat,
+    gzipped on the fly with gzip=1
+    """
+    chunk_size = 1000
+    fields = ('student_id', 'unique_id', 'status', 'used_time', 'modified_time')
+    formats = {
+        'csv': ('text/csv; charset=utf-8', 'csv'),
+        'jsonl': ('application/x-ndjson; charset=utf-8', 'jsonl'),
+    }
+
+    def rows(self, tickets):
+        last_id = 0
+        while True:
+            chunk = list(tickets.filter(id__gt=last_id).order_by('id').values_list('id', *self.fields)[:self.chunk_size])
+            if not chunk:
+                return
+            last_id = chunk[-1][0]
+            yield [[x.isoformat() if isinstance(x, datetime.datetime) else x for x in row[1:]] for row in chunk]
+
+    def render_csv(self, chunks):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(self.fields)
+        for rows in chunks:
+            writer.writerows(rows)
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')  # header of an empty export
+
+    def render_jsonl(self, chunks):
+        for rows in chunks:
+            yield ''.join(json.dumps(dict(zip(self.fields, row)), ensure_ascii=False) + '\n'
+                          for row in rows).encode('utf-8')
+
+    @staticmethod
+    def gzip(chunks):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    @require_logged_in
+    def get(self):
+        self.check_input('actId')
+        try:
+            activity = Activity.objects.get(id=self.input['actId'])
+        except (Activity.DoesNotExist, TypeError, ValueError):
+            raise LogicError('Activity not found')
+        fmt = self.input.get('format') or 'csv'
+        if fmt not in self.formats:
+            raise InputError('Field "format" should be one of %s' % (', '.join(sorted(self.formats)), ))
+        tickets = Ticket.objects.filter(activity=activity).exclude(status=Ticket.STATUS_UNCLAIMED)
+        status = self.input.get('status')
+        if status not in (None, ''):
+            try:
+                tickets = tickets.filter(status__in=[int(x) for x in str(status).split(',')])
+            except ValueError:
+                raise InputError('Field "status" should be integers separated by commas')
+        content_type, extension = self.formats[fmt]
+        content = getattr(self, 'render_' + fmt)(self.rows(tickets))
+        if self.input.get('gzip') in ('1', 'true'):
+            content, content_type, extension = self.gzip(content), 'application/gzip', extension + '.gz'
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="tickets-%d.%s"' % (activity.id, extension)
+        return response
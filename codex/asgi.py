@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+import asyncio
+import io
+import re
+import sys
+import urllib.parse
+
+
+__author__ = "Epsirom"
+
+
+class AsgiRequest(object):
+
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.method = scope['method']
+        self.path = scope['path']
+        self.body = body
+        self.GET = {k: v[-1] for k, v in urllib.parse.parse_qs(
+            scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True
+        ).items()}
+
+
+async def read_request(scope, receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return AsgiRequest(scope, b''.join(chunks))
+
+
+async def send_response(send, status, body=b'', content_type='text/plain; charset=utf-8', headers=()):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('latin-1')),
+                    (b'content-length', str(len(body)).encode('latin-1'))] + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class AsgiRouter(object):
+    """
+    ASGI application dispatching http requests by path regex, to fallback (e.g. a WsgiBridge) if nothing matches
+    """
+
+    def __init__(self, routes, fallback):
+        self.routes = [(re.compile(pattern), app) for pattern, app in routes]
+        self.fallback = fallback
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type %s' % scope['type'])
+        for pattern, app in self.routes:
+            if pattern.match(scope['path']):
+                return await app(scope, receive, send)
+        return await self.fallback(scope, receive, send)
+
+
+class WsgiBridge(object):
+    """
+    Serve a WSGI application from ASGI.
+    The application runs and its response is iterated in one executor job, so that thread-local resources
+    (e.g. database connections closed on request_finished) stay in one thread.
+    Chunks are handed to the event loop through a queue of buffer_chunks, which throttles the job to the client.
+    """
+
+    def __init__(self, wsgi_app, executor, buffer_chunks=8):
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+        self.buffer_chunks = buffer_chunks
+
+    @staticmethod
+    def build_environ(request):
+        scope = request.scope
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+            'CONTENT_LENGTH': str(len(request.body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(request.body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = 'HTTP_' + name
+                environ[key] = environ[key] + ',' + value if key in environ else value
+        return environ
+
+    async def __call__(self, scope, receive, send):
+        request = await read_request(scope, receive)
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(maxsize=self.buffer_chunks)
+        aborted = []
+
+        def put(item):
+            if aborted:
+                raise ConnectionAbortedError('ASGI client went away')
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            put((int(status.split(' ', 1)[0]), [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                                                for k, v in headers]))
+
+        def run(environ):
+            try:
+                result = self.wsgi_app(environ, start_response)
+                try:
+                    for chunk in result:
+                        if chunk:
+                            put(chunk)
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+            finally:
+                asyncio.run_coroutine_threadsafe(queue.put(None), loop)
+
+        job = loop.run_in_executor(self.executor, run, self.build_environ(request))
+        try:
+            head = await queue.get()
+            if head is None:
+                await job  # raises what the application raised
+                raise RuntimeError('WSGI application returned without calling start_response')
+            await send({'type': 'http.response.start', 'status': head[0], 'headers': head[1]})
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        except BaseException:
+            aborted.append(True)
+            while not job.done() or not queue.empty():  # unblock the job so that it closes the response
+                if (await queue.get()) is None:
+                    break
+            raise
+        await job
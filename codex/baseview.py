@@ -4,6 +4,7 @@ import json
 import logging
 
 from django.http import HttpResponse
+from django.http.response import HttpResponseBase
 from django.views.generic import View
 
 from codex.baseerror import BaseError, InputError
@@ -31,6 +32,8 @@ class APIView(BaseView):
 
     logger = logging.getLogger('API')
 
+    etag = None
+
     def do_dispatch(self, *args, **kwargs):
         self.input = self.query or self.body
         handler = getattr(self, self.request.method.lower(), None)
@@ -63,6 +66,8 @@ class APIView(BaseView):
         result = None
         try:
             result = func(*args, **kwargs)
+            if isinstance(result, HttpResponseBase):  # including StreamingHttpResponse
+                return self.tag_response(result)
         except BaseError as e:
             code = e.code
             msg = e.msg
@@ -86,7 +91,23 @@ class APIView(BaseView):
                 'msg': msg,
                 'data': None,
             })
-        return HttpResponse(response, content_type='application/json')
+        response = HttpResponse(response, content_type='application/json')
+        return self.tag_response(response) if code == 0 else response
+
+    def not_modified(self, etag):
+        """
+        Tag the response with etag, e.g. if self.not_modified(etag): return HttpResponseNotModified()
+        :return: True if the client has the response of etag already
+        """
+        self.etag = '"%s"' % etag
+        tags = self.request.META.get('HTTP_IF_NONE_MATCH', '')
+        return any(tag.strip().replace('W/', '', 1) in (self.etag, '*') for tag in tags.split(',') if tag.strip())
+
+    def tag_response(self, response):
+        if self.etag is not None:
+            response['ETag'] = self.etag
+            response['Cache-Control'] = 'private, no-cache'  # revalidate every time
+        return response
 
     def check_input(self, *keys):
         for k in keys:
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+#
+import collections
+import threading
+import time
+
+
+__author__ = "Epsirom"
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-process LRU cache, entries expire ttl seconds after they are set (never if ttl is None)
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return default
+            value, expire = item
+            if expire is not None and expire <= time.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expire = None if self.ttl is None else time.monotonic() + self.ttl
+        with self.lock:
+            self.data[key] = (value, expire)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+import bisect
+import http.client
+import socket
+import threading
+import time
+import urllib.parse
+
+
+__author__ = "Epsirom"
+
+
+class ResponseTimeHistogram(object):
+    """
+    Count of requests by response time, bounds are upper bounds of buckets in seconds
+    """
+    bounds = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * len(self.bounds)
+        self.total = 0.0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+            self.total += seconds
+            if error:
+                self.errors += 1
+
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, p):
+        """
+        :return: upper bound of the bucket holding the p-th percentile (0 < p <= 100), 0 if nothing observed
+        """
+        with self.lock:
+            counts = list(self.counts)
+        rank = sum(counts) * p / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds, counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0
+
+    def snapshot(self):
+        with self.lock:
+            count = sum(self.counts)
+            return {
+                'count': count,
+                'errors': self.errors,
+                'mean': self.total / count if count else 0,
+                'buckets': list(zip(self.bounds, self.counts)),
+            }
+
+
+class HttpClient(object):
+    """
+    Thread-safe HTTP/1.1 client keeping connections alive: idle connections are pooled by (scheme, host),
+    at most max_connections requests are in flight, and every request has a timeout.
+    """
+
+    def __init__(self, max_connections=10, timeout=5):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.idle = dict()
+        self.histogram = ResponseTimeHistogram()
+
+    def _connect(self, scheme, netloc, timeout):
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(netloc, timeout=timeout)
+        elif scheme == 'http':
+            conn = http.client.HTTPConnection(netloc, timeout=timeout)
+        else:
+            raise ValueError('Unsupported scheme %s' % scheme)
+        conn.connect()
+        # headers and body are sent separately, do not let Nagle hold the body back until the headers are acked
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+
+    def _acquire_connection(self, key, timeout):
+        """
+        :return: (connection, reused)
+        """
+        with self.lock:
+            pool = self.idle.get(key)
+            conn = pool.pop() if pool else None
+        if conn is None:
+            return self._connect(key[0], key[1], timeout), False
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def _release_connection(self, key, conn):
+        with self.lock:
+            pool = self.idle.setdefault(key, list())
+            if len(pool) < self.max_connections:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """
+        :return: (status, body in bytes)
+        :raise: socket.timeout if the server does not answer in timeout seconds, OSError or HTTPException
+        """
+        timeout = self.timeout if timeout is None else timeout
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if not self.semaphore.acquire(timeout=timeout):
+            raise TimeoutError('No connection to %s available in %s seconds' % (parts.netloc, timeout))
+        begin = time.monotonic()
+        try:
+            while True:
+                conn, reused = self._acquire_connection(key, timeout)
+                try:
+                    conn.request(method, path, body, headers or {})
+                    response = conn.getresponse()
+                    data = response.read()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    conn.close()
+                    if reused:
+                        continue  # the server closed the idle connection, try again on a new one
+                    raise
+                except:
+                    conn.close()
+                    raise
+                if response.will_close:
+                    conn.close()
+                else:
+                    self._release_connection(key, conn)
+                self.histogram.observe(time.monotonic() - begin)
+                return response.status, data
+        except:
+            self.histogram.observe(time.monotonic() - begin, error=True)
+            raise
+        finally:
+            self.semaphore.release()
+
+    def close(self):
+        with self.lock:
+            pools, self.idle = self.idle, dict()
+        for pool in pools.values():
+            for conn in pool:
+                conn.close()
@@ -227,6 +227,29 @@ class UserPageTest(TestCase):
         resp = json.loads(resp.content.decode())
         self.assertNotEqual(resp['code'], 0)
 
+    def test_ticket_detail_get_token(self):
+        # a signed ticket token, viewed by its owner
+        owner = '921E1460FD86481C9087C7E2A9B7C6322967F79BDFC34ED2873EFC8106EDC38A'
+        ticket = Ticket.get_by_ticket_unique_id('6131D02D549744E29D335CAC9E60FAB2')
+        token = ticket.issue_token()
+        self.assertEqual(Ticket.verify_token(token), (ticket.id, ticket.activity_id, ticket.student_id))
+        resp = self.client.get('/api/u/ticket/detail', {'openid': owner, 'ticket': token})
+        resp = json.loads(resp.content.decode())
+        self.assertEqual(resp['code'], 0)
+        self.assertEqual(resp['data']['uniqueId'], ticket.unique_id)
+
+        # somebody who saw the door QR code
+        resp = self.client.get('/api/u/ticket/detail', {
+            'openid': '48A3CB2513F049A98A7DFD2453ED717296F3D2B76DC7407DB3886D5F4F4B5C04', 'ticket': token
+        })
+        self.assertNotEqual(json.loads(resp.content.decode())['code'], 0)
+
+        other = Ticket.get_by_ticket_unique_id('D42789364EA04E228585AEE95562D487')
+        forged = '%d.%d.%s:%s' % (other.id, other.activity_id, owner, token.rsplit(':', 1)[1])
+        self.assertIsNone(Ticket.verify_token(forged))
+        resp = json.loads(self.client.get('/api/u/ticket/detail', {'openid': owner, 'ticket': forged}).content.decode())
+        self.assertNotEqual(resp['code'], 0)
+
     def tearDown(self):
         User.objects.all().delete()
         Activity.objects.all().delete()
@@ -42,7 +42,7 @@ class ActivityDetail(APIView):
             'bookEnd': int(activity.book_end.timestamp()),
             'totalTickets': activity.total_tickets,
             'picUrl': activity.pic_url,
-            'remainTickets': activity.remain_tickets,
+            'remainTickets': activity.get_remain_tickets(),
             'currentTime': int(time.time())
         }
 
@@ -65,6 +65,7 @@ class TicketDetail(APIView):
             'place': activity.place,
             'activityKey': activity.key,
             'uniqueId': ticket.unique_id,
+            'token': ticket.issue_token(),
             'startTime': int(activity.start_time.timestamp()),
             'endTime': int(activity.end_time.timestamp()),
             'currentTime': int(time.time()),
@@ -75,6 +76,15 @@ class TicketDetail(APIView):
         self.check_input('openid', 'ticket')
         openid = self.input['openid']
         ticket_unique_id = self.input['ticket']
+        if Ticket.is_token(ticket_unique_id):
+            # the token is shown as the door QR code, so it proves which ticket is meant but not who is viewing
+            verified = Ticket.verify_token(ticket_unique_id)
+            if verified is None or User.get_by_openid(openid).student_id != verified[2]:
+                raise ValidateError('You don\'t have permission to view this ticket.')
+            ticket = Ticket.objects.select_related('activity').get(id=verified[0])
+            if ticket.student_id != verified[2]:
+                raise ValidateError('You don\'t have permission to view this ticket.')
+            return TicketDetail.make_detail(ticket)
         ticket = Ticket.get_by_ticket_unique_id(ticket_unique_id)
 
         # check if owner of the ticket has same student_id with the query
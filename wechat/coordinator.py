@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+import logging
+import threading
+
+from wechat.models import Ticket
+
+
+__author__ = "Epsirom"
+
+
+class BookingBatch(object):
+
+    def __init__(self, activity):
+        self.activity = activity
+        self.student_ids = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = {}
+        self.error = None
+
+
+class BookingCoordinator(object):
+    """
+    Group commit for snap-up requests of the same activity.
+    The first request of a batch becomes the leader: it waits for `window` seconds (or until `max_batch` requests
+    arrived), then books the whole batch in one transaction with Ticket.book_tickets and wakes up the others.
+    """
+    logger = logging.getLogger('WeChat')
+
+    def __init__(self, window=0.005, max_batch=200):
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.pending = dict()
+
+    def book(self, student_id, activity):
+        """
+        :return: the booked Ticket, None if sold out
+        """
+        if self.window <= 0:
+            return Ticket.book_ticket(student_id=student_id, activity=activity)
+        with self.lock:
+            batch = self.pending.get(activity.id)
+            is_leader = batch is None
+            if is_leader:
+                batch = self.pending[activity.id] = BookingBatch(activity)
+            batch.student_ids.append(student_id)
+            if len(batch.student_ids) >= self.max_batch:
+                del self.pending[activity.id]  # later requests start a new batch
+                batch.full.set()
+        if is_leader:
+            self.commit(batch)
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.results.get(student_id)
+
+    def commit(self, batch):
+        batch.full.wait(self.window)
+        with self.lock:
+            if self.pending.get(batch.activity.id) is batch:
+                del self.pending[batch.activity.id]
+        try:
+            batch.results = Ticket.book_tickets(batch.student_ids, batch.activity)
+            self.logger.debug('Booked %d of %d requests for activity %d in one transaction',
+                              len(batch.results), len(batch.student_ids), batch.activity.id)
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Stand-in for api.weixin.qq.com serving what WeChatLib calls: cgi-bin/token, cgi-bin/menu/get, cgi-bin/menu/create
+and cgi-bin/message/custom/send. Point WECHAT_API_ROOT at FakeWeChatApi.url to use it.
+"""
+import collections
+import contextlib
+import json
+import logging
+import os
+import random
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from codex.httpclient import HttpClient
+from wechat.tokenstore import FileTokenStore
+from wechat.wrapper import WeChatLib
+
+
+__author__ = "Epsirom"
+
+
+class FakeWeChatApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real server
+    disable_nagle_algorithm = True  # headers and body are written separately
+
+    def setup(self):
+        super(FakeWeChatApiHandler, self).setup()
+        self.server.api.count('connections')
+
+    def log_message(self, fmt, *args):
+        self.server.api.logger.debug(fmt, *args)
+
+    def reply(self, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self, method):
+        api = self.server.api
+        parts = urllib.parse.urlsplit(self.path)
+        query = {k: v[-1] for k, v in urllib.parse.parse_qs(parts.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        api.count(parts.path)
+        if api.latency:
+            time.sleep(random.uniform(*api.latency))
+        handler = api.routes.get((method, parts.path))
+        if handler is None:
+            self.send_error(404)
+            return
+        if api.error_rate and random.random() < api.error_rate:
+            api.count('errors')
+            self.reply({'errcode': -1, 'errmsg': 'system error'})
+            return
+        try:
+            data = json.loads(body.decode('utf-8')) if body else None
+        except ValueError:
+            self.reply({'errcode': 47001, 'errmsg': 'data format error'})
+            return
+        self.reply(handler(query, data))
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+
+class FakeWeChatApiServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeWeChatApi(object):
+    """
+    :param latency: seconds added to every call, a number or a (min, max) range
+    :param error_rate: fraction of calls failing with errcode -1 (system error)
+    :param token_ttl: expires_in of access tokens, calls with an expired token fail with errcode 42001
+    :param appid, secret: credentials accepted by cgi-bin/token, None accepts any
+    """
+    logger = logging.getLogger('fakeapi')
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0, token_ttl=7200, appid=None, secret=None):
+        self.latency = latency if isinstance(latency, (tuple, list)) else ((latency, latency) if latency else None)
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.appid = appid
+        self.secret = secret
+        self.lock = threading.Lock()
+        self.tokens = dict()  # access_token -> expire time
+        self.menu = None
+        self.messages = list()
+        self.counts = collections.Counter()
+        self.routes = {
+            ('GET', '/cgi-bin/token'): self.token,
+            ('GET', '/cgi-bin/menu/get'): self.menu_get,
+            ('POST', '/cgi-bin/menu/create'): self.menu_create,
+            ('POST', '/cgi-bin/message/custom/send'): self.custom_send,
+        }
+        self.server = FakeWeChatApiServer((host, port), FakeWeChatApiHandler)
+        self.server.api = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def check_token(self, query):
+        """
+        :return: error response, None if the access token is good
+        """
+        with self.lock:
+            expire = self.tokens.get(query.get('access_token'))
+        if expire is None:
+            return {'errcode': 40001, 'errmsg': 'invalid credential, access_token is invalid or not latest'}
+        if expire <= time.time():
+            return {'errcode': 42001, 'errmsg': 'access_token expired'}
+        return None
+
+    def token(self, query, data):
+        if query.get('grant_type') != 'client_credential':
+            return {'errcode': 40002, 'errmsg': 'invalid grant_type'}
+        if (self.appid is not None and query.get('appid') != self.appid) or \
+                (self.secret is not None and query.get('secret') != self.secret):
+            return {'errcode': 40125, 'errmsg': 'invalid appsecret'}
+        access_token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[access_token] = time.time() + self.token_ttl
+        return {'access_token': access_token, 'expires_in': self.token_ttl}
+
+    def menu_get(self, query, data):
+        error = self.check_token(query)
+        if error is not None:
+            return error
+        if self.menu is None:
+            return {'errcode': 46003, 'errmsg': 'menu no exist'}
+        return {'menu': self.menu}
+
+    def menu_create(self, query, data):
+        error = self.check_token(query)
+        if error is not None:
+            return error
+        if not isinstance(data, dict) or not data.get('button'):
+            return {'errcode': 40016, 'errmsg': 'invalid button size'}
+        self.menu = data
+        return {'errcode': 0, 'errmsg': 'ok'}
+
+    def custom_send(self, query, data):
+        error = self.check_token(query)
+        if error is not None:
+            return error
+        if not isinstance(data, dict) or not data.get('touser') or data.get('msgtype') not in data:
+            return {'errcode': 47001, 'errmsg': 'data format error'}
+        with self.lock:
+            self.messages.append(data)
+        return {'errcode': 0, 'errmsg': 'ok'}
+
+    def start(self):
+        """
+        Serve in a background thread
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fakeapi', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+@contextlib.contextmanager
+def wechat_lib_using(api_root, max_connections=10, timeout=5):
+    """
+    Point WeChatLib at api_root with a connection pool and a token store of its own, restored on exit
+    :return: the HttpClient, whose histogram records the calls
+    """
+    tmpdir = tempfile.mkdtemp()
+    saved = WeChatLib.api_root, WeChatLib.http, WeChatLib.token_store
+    WeChatLib.api_root = api_root
+    WeChatLib.http = HttpClient(max_connections, timeout)
+    WeChatLib.token_store = FileTokenStore(os.path.join(tmpdir, 'access_token.json'), WeChatLib.fetch_access_token)
+    try:
+        yield WeChatLib.http
+    finally:
+        WeChatLib.token_store.stop()
+        WeChatLib.http.close()
+        WeChatLib.api_root, WeChatLib.http, WeChatLib.token_store = saved
+        shutil.rmtree(tmpdir, ignore_errors=True)
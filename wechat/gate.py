@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#
+import datetime
+import logging
+import threading
+
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils import timezone
+
+from WeChatTicket import settings
+from wechat.models import Activity, Ticket
+
+
+__author__ = "Epsirom"
+
+
+class Gate(object):
+    """
+    Tickets of an activity held in memory while its doors are open: scans are checked against the index
+    and the used-marks are written with Ticket.check_in in batches, in the background every flush_interval
+    seconds (at once if 0).
+    A ticket missing from the index (booked after loading) is looked up once. Tickets changed since the last
+    sync (cancelled ones in particular) are read by their modified_time with every flush, before every check if
+    flush_interval is 0. A ticket accepted by the gate of another process is caught by the flush, which logs it.
+    """
+    logger = logging.getLogger('gate')
+
+    # seconds a sync reaches back, for tickets committed with a modified_time older than the previous sync
+    sync_overlap = 5
+
+    def __init__(self, activity, flush_interval=1):
+        self.activity = activity
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.tickets = dict()  # unique_id -> student_id of valid and used tickets
+        self.students = dict()  # student_id -> unique_id, the valid ticket if the student has several
+        self.used = set()  # unique_ids
+        self.pending = list()  # scans of Ticket.check_in to be flushed
+        self.synced_at = None
+        self.stopped = threading.Event()
+        self.flusher = None
+
+    def load(self):
+        self.synced_at = timezone.now()
+        rows = Ticket.objects.filter(activity=self.activity, status__in=(Ticket.STATUS_VALID, Ticket.STATUS_USED)) \
+            .values_list('unique_id', 'student_id', 'status')
+        with self.lock:
+            for unique_id, student_id, status in rows.iterator():
+                self.add(unique_id, student_id, status)
+        return self
+
+    def sync(self):
+        """
+        Apply the tickets changed since the last sync, dropping cancelled ones from the index
+        :return: number of tickets changed
+        """
+        now = timezone.now()
+        rows = list(Ticket.objects.filter(
+            activity=self.activity, modified_time__gte=self.synced_at - datetime.timedelta(seconds=self.sync_overlap)
+        ).exclude(status=Ticket.STATUS_UNCLAIMED).values_list('unique_id', 'student_id', 'status'))
+        with self.lock:
+            for unique_id, student_id, status in rows:
+                if status == Ticket.STATUS_CANCELLED:
+                    self.discard(unique_id, student_id)
+                else:
+                    self.add(unique_id, student_id, status)
+            self.synced_at = now
+        return len(rows)
+
+    def discard(self, unique_id, student_id):
+        self.tickets.pop(unique_id, None)
+        if self.students.get(student_id) == unique_id:
+            del self.students[student_id]
+
+    def add(self, unique_id, student_id, status):
+        self.tickets[unique_id] = student_id
+        if status == Ticket.STATUS_USED:
+            self.used.add(unique_id)
+        if student_id not in self.students or status == Ticket.STATUS_VALID:
+            self.students[student_id] = unique_id
+
+    def lookup(self, unique_id, student_id):
+        """
+        Load a ticket booked after the index
+        """
+        query = Ticket.objects.filter(activity=self.activity, status__in=(Ticket.STATUS_VALID, Ticket.STATUS_USED))
+        if unique_id is not None:
+            query = query.filter(unique_id=unique_id)
+        else:
+            query = query.filter(student_id=student_id).order_by('status')  # the valid ticket first
+        row = query.values_list('unique_id', 'student_id', 'status').first()
+        if row is not None:
+            with self.lock:
+                self.add(*row)
+
+    def check(self, unique_id=None, student_id=None):
+        """
+        :return: (unique_id, student_id, result) as Ticket.check_in
+        """
+        if self.flush_interval <= 0:
+            self.sync()
+        for attempt in range(2):
+            with self.lock:
+                if unique_id is not None:
+                    found = unique_id in self.tickets
+                    scanned_unique_id, scanned_student_id = unique_id, self.tickets.get(unique_id)
+                else:
+                    found = student_id in self.students
+                    scanned_unique_id, scanned_student_id = self.students.get(student_id), student_id
+                if found:
+                    if scanned_unique_id in self.used:
+                        return scanned_unique_id, scanned_student_id, 'used'
+                    self.used.add(scanned_unique_id)
+                    self.pending.append((scanned_unique_id, None, timezone.now()))
+                    break
+            if attempt:
+                return unique_id, student_id, 'rejected' if unique_id is not None else 'noticket'
+            self.lookup(unique_id, student_id)
+        if self.flush_interval <= 0:
+            self.flush()
+        return scanned_unique_id, scanned_student_id, 'accepted'
+
+    def flush(self):
+        """
+        Write pending used-marks to the database
+        :return: number of scans written
+        """
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, list()
+            if not pending:
+                return 0
+            try:
+                results = Ticket.check_in(self.activity, pending)
+            except Exception:
+                with self.lock:
+                    self.pending = pending + self.pending
+                raise
+            for unique_id, student_id, result in results:
+                if result != 'accepted':
+                    self.logger.warning('Ticket %s of %s accepted at the gate of %s was %s in the database',
+                                        unique_id, student_id, self.activity.id, result)
+            return len(pending)
+
+    def start(self):
+        if self.flush_interval > 0:
+            self.flusher = threading.Thread(target=self.run_flusher, name='gate-%s' % self.activity.id, daemon=True)
+            self.flusher.start()
+        return self
+
+    def run_flusher(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+                self.sync()
+            except Exception:
+                self.logger.exception('Failed to flush the gate of %s, retry in %s seconds',
+                                      self.activity.id, self.flush_interval)
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        self.stopped.set()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+        self.flush()
+
+
+class GateRegistry(object):
+    """
+    Activities in gate mode, as a flag in CACHES so that every process serving check-in uses its own Gate
+    """
+    open_key = 'wechat:gate:%s'
+    open_timeout = 24 * 60 * 60
+
+    def __init__(self, flush_interval=1):
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.gates = dict()
+
+    def is_open(self, activity_id):
+        return bool(cache.get(self.open_key % (activity_id, )))
+
+    def open(self, activity):
+        cache.set(self.open_key % (activity.id, ), True, self.open_timeout)
+        return self.get(activity.id)
+
+    def close(self, activity_id):
+        cache.delete(self.open_key % (activity_id, ))
+        with self.lock:
+            gate = self.gates.pop(activity_id, None)
+        if gate is not None:
+            gate.stop()
+
+    def get(self, activity_id):
+        """
+        :return: Gate of the activity in this process, None if not in gate mode
+        """
+        if not self.is_open(activity_id):
+            if activity_id in self.gates:
+                self.close(activity_id)  # closed by another process
+            return None
+        gate = self.gates.get(activity_id)
+        if gate is None:
+            with self.lock:
+                gate = self.gates.get(activity_id)
+                if gate is None:
+                    activity = Activity.objects.get(id=activity_id)
+                    gate = self.gates[activity_id] = Gate(activity, self.flush_interval).load().start()
+        return gate
+
+
+gates = GateRegistry(settings.GATE_FLUSH_INTERVAL)
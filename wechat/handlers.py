@@ -1,17 +1,19 @@
 # -*- coding: utf-8 -*-
 #
+import threading
 import time
 
 from django.utils import timezone
 
 from codex.baseerror import LogicError
-from wechat.models import Activity, Ticket
+from wechat.models import Activity, Ticket, LotteryEntry, WaitlistEntry
 from wechat.wrapper import WeChatHandler
 
 __author__ = "Epsirom"
 
 
 class ErrorHandler(WeChatHandler):
+    blocking = False
 
     def check(self):
         return True
@@ -21,6 +23,7 @@ class ErrorHandler(WeChatHandler):
 
 
 class DefaultHandler(WeChatHandler):
+    blocking = False
 
     def check(self):
         return True
@@ -30,10 +33,9 @@ class DefaultHandler(WeChatHandler):
 
 
 class HelpOrSubscribeHandler(WeChatHandler):
-
-    def check(self):
-        return self.is_text('帮助', 'help') or self.is_event('scan', 'subscribe') or \
-               self.is_event_click(self.view.event_keys['help'])
+    texts = ('帮助', 'help')
+    events = ('scan', 'subscribe')
+    click_keys = ('help', )
 
     def handle(self):
         return self.reply_single_news({
@@ -44,9 +46,8 @@ class HelpOrSubscribeHandler(WeChatHandler):
 
 
 class UnbindOrUnsubscribeHandler(WeChatHandler):
-
-    def check(self):
-        return self.is_text('解绑') or self.is_event('unsubscribe')
+    texts = ('解绑', )
+    events = ('unsubscribe', )
 
     def handle(self):
         self.user.student_id = ''
@@ -55,31 +56,23 @@ class UnbindOrUnsubscribeHandler(WeChatHandler):
 
 
 class BindAccountHandler(WeChatHandler):
-
-    def check(self):
-        return self.is_text('绑定') or self.is_event_click(self.view.event_keys['account_bind'])
+    texts = ('绑定', )
+    click_keys = ('account_bind', )
 
     def handle(self):
         return self.reply_text(self.get_message('bind_account'))
 
 
 class BookEmptyHandler(WeChatHandler):
-
-    def check(self):
-        return self.is_event_click(self.view.event_keys['book_empty'])
+    click_keys = ('book_empty', )
 
     def handle(self):
         return self.reply_text(self.get_message('book_empty'))
 
 
 class SnapUpTicketHandler(WeChatHandler):
-
-    def is_event_click_startswith(self, *event_keys):
-        return self.is_msg_type('event') and (self.input['Event'] == 'CLICK') and any(
-            self.input['EventKey'].startswith(event_key) for event_key in event_keys)
-
-    def check(self):
-        return self.is_text_command('抢票') or self.is_event_click_startswith(self.view.event_keys['book_header'])
+    commands = ('抢票', )
+    click_key_prefixes = ('book_header', )
 
     def get_activity(self):
         """
@@ -131,11 +124,18 @@ class SnapUpTicketHandler(WeChatHandler):
         if self.get_current_time() > activity.book_end.timestamp():  # end already
             return self.reply_text(self.get_message('book_end_already'))
 
-        result = Activity.decrease_ticket_exclusive(activity.id)
-        if not result:
-            return self.reply_text(self.get_message('sold_out'))
+        if activity.waitlist_open:  # cancelled tickets are kept for the waitlist
+            return self.reply_text(self.get_message('sold_out', activity=activity))
+
+        if activity.book_mode == Activity.BOOK_MODE_LOTTERY:
+            if LotteryEntry.enter(self.user.student_id, activity):
+                return self.reply_text(self.get_message('lottery_entered', activity=activity))
+            return self.reply_text(self.get_message('lottery_already_entered', activity=activity))
+
+        ticket = self.view.booking.book(self.user.student_id, activity)
+        if ticket is None:
+            return self.reply_text(self.get_message('sold_out', activity=activity))
 
-        ticket = Ticket.create_ticket(student_id=self.user.student_id, activity=activity)
         return self.reply_single_news({
             'Title': self.get_message('book_ticket_success_title'),
             'Description': self.get_message('book_ticket_success_detail', activity=activity),
@@ -145,9 +145,7 @@ class SnapUpTicketHandler(WeChatHandler):
 
 
 class CancelTicketHandler(WeChatHandler):
-
-    def check(self):
-        return self.is_text_command('退票')
+    commands = ('退票', )
 
     def handle(self):
         text = self.extract_activity_name()
@@ -164,17 +162,48 @@ class CancelTicketHandler(WeChatHandler):
         if ticket is None:
             return self.reply_text(self.get_message('no_ticket_in_hand'))
 
-        Activity.increase_ticket_exclusive(activity.id)
-        ticket.status = Ticket.STATUS_CANCELLED
-        ticket.save()
+        if not Ticket.cancel_ticket(ticket, activity):
+            return self.reply_text(self.get_message('no_ticket_in_hand'))
 
         return self.reply_text(self.get_message('cancel_complete', activity=activity))
 
 
-class WithdrawTicketHandler(WeChatHandler):
+class JoinWaitlistHandler(WeChatHandler):
+    commands = ('候补', )
 
-    def check(self):
-        return self.is_text_command('取票')
+    def handle(self):
+        text = self.extract_activity_name()
+
+        activity = Activity.objects.filter(key=text).first()
+        if activity is None or activity.status != Activity.STATUS_PUBLISHED:
+            return self.reply_text(self.get_message('activity_not_found'))
+
+        if self.user.student_id == '':  # not bind yet
+            return self.reply_text(self.get_message('id_not_bind'))
+
+        now = timezone.now()
+        if now < activity.book_start:  # not start yet
+            return self.reply_text(self.get_message('book_not_start'))
+
+        if now > activity.book_end:  # end already
+            return self.reply_text(self.get_message('book_end_already'))
+
+        if Ticket.objects.filter(student_id=self.user.student_id, activity=activity,
+                                 status=Ticket.STATUS_VALID).exists():
+            return self.reply_text(self.get_message('already_booked'))
+
+        # opening the waitlist stops first-come booking, so it is opened only once everything is booked
+        if not activity.waitlist_open and activity.get_remain_tickets() > 0:
+            return self.reply_text(self.get_message('waitlist_not_sold_out', activity=activity))
+
+        position = WaitlistEntry.enter(self.user.student_id, activity)
+        if position is None:
+            return self.reply_text(self.get_message('waitlist_already_entered', activity=activity))
+        return self.reply_text(self.get_message('waitlist_entered', activity=activity, position=position))
+
+
+class WithdrawTicketHandler(WeChatHandler):
+    commands = ('取票', )
 
     def handle(self):
         text = self.extract_activity_name()
@@ -200,23 +229,42 @@ class WithdrawTicketHandler(WeChatHandler):
 
 
 class BookWhatHandler(WeChatHandler):
+    click_keys = ('book_what', )
 
-    def check(self):
-        return self.is_event_click(self.view.event_keys['book_what'])
-
-    def handle(self):
-        activities = Activity.objects.filter(
-            status=Activity.STATUS_PUBLISHED, book_end__gt=timezone.now()
-        ).order_by('book_end')
+    # (Activity list version, time when the first listed activity stops booking, articles) of this process
+    snapshot = None
+    snapshot_lock = threading.Lock()
 
-        articles = []
-        for activity in activities:
-            articles.append({
+    def get_articles(self):
+        """
+        Rebuilt only when an activity has been created, edited or deleted, or a listed one crossed book_end
+        """
+        version = Activity.get_list_version()
+        now = timezone.now()
+
+        def is_fresh(snapshot):
+            return snapshot is not None and snapshot[0] == version and (snapshot[1] is None or now < snapshot[1])
+
+        if is_fresh(self.snapshot):
+            return self.snapshot[2]
+        with self.snapshot_lock:
+            if is_fresh(self.snapshot):  # rebuilt by another thread meanwhile
+                return self.snapshot[2]
+            activities = list(Activity.objects.filter(
+                status=Activity.STATUS_PUBLISHED, book_end__gt=now
+            ).order_by('book_end').only('id', 'name', 'description', 'pic_url', 'book_end', 'version')[
+                : self.article_limit])
+            articles = [{
                 'Title': self.get_message('activity_title', activity=activity),
                 'Description': self.get_message('activity_description', activity=activity),
                 'Url': WeChatHandler.url_activity_detail(activity),
                 'PicUrl': activity.pic_url,
-            })
+            } for activity in activities]
+            BookWhatHandler.snapshot = (version, activities[0].book_end if activities else None, articles)
+        return articles
+
+    def handle(self):
+        articles = self.get_articles()
 
         if len(articles) == 0:
             return self.reply_text(self.get_message('book_empty'))
@@ -225,28 +273,18 @@ class BookWhatHandler(WeChatHandler):
 
 
 class LookUpTicketHandler(WeChatHandler):
-
-    def check(self):
-        return self.is_event_click(self.view.event_keys['get_ticket'])
+    click_keys = ('get_ticket', )
 
     def handle(self):
         if self.user.student_id == '':  # not bind yet
             return self.reply_text(self.get_message('id_not_bind'))
 
-        tickets = Ticket.objects.filter(
-            status=Ticket.STATUS_VALID, student_id=self.user.student_id
-        ).order_by('id')
-
-        articles = []
-        for ticket in tickets:
-            activity = ticket.activity
-            if activity.status == Activity.STATUS_PUBLISHED:  # deleted activity will be excluded
-                articles.append({
-                    'Title': self.get_message('ticket_title', activity=activity),
-                    'Description': self.get_message('ticket_description', activity=activity),
-                    'Url': self.url_ticket_detail(ticket),
-                    'PicUrl': activity.pic_url,
-                })
+        articles = [{
+            'Title': self.get_message('ticket_title', activity=ticket.activity),
+            'Description': self.get_message('ticket_description', activity=ticket.activity),
+            'Url': self.url_ticket_detail(ticket),
+            'PicUrl': ticket.activity.pic_url,
+        } for ticket in Ticket.get_valid_list(self.user.student_id, self.article_limit)]
 
         if len(articles) == 0:
             return self.reply_text(self.get_message('ticket_empty'))
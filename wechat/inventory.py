@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+from django.db import transaction
+from django.db.models import F
+
+
+__author__ = "Epsirom"
+
+
+class TicketInventory(object):
+    """
+    Backend that keeps Activity.remain_tickets in sync with bookings.
+    Activity.decrease_ticket_exclusive / increase_ticket_exclusive delegate to it.
+    """
+
+    def decrease(self, model, activity_id):
+        """
+        :return: True if one ticket has been taken, False if sold out or activity not found
+        """
+        raise NotImplementedError('You should implement decrease() in sub-class of TicketInventory')
+
+    def increase(self, model, activity_id):
+        raise NotImplementedError('You should implement increase() in sub-class of TicketInventory')
+
+
+class LockingTicketInventory(TicketInventory):
+    """
+    Loads the whole activity row with SELECT ... FOR UPDATE and saves it back.
+    Every booking queues on the row lock, kept as the reference implementation for benchmarking.
+    """
+
+    def decrease(self, model, activity_id):
+        with transaction.atomic():
+            try:
+                activity = model.objects.select_for_update().get(id=activity_id)
+            except model.DoesNotExist:
+                return False  # cannot find activity, book fail
+            if activity.remain_tickets <= 0:
+                return False  # no ticket remained
+            activity.remain_tickets -= 1
+            activity.save()
+            return True  # book ticket success
+
+    def increase(self, model, activity_id):
+        with transaction.atomic():
+            try:
+                activity = model.objects.select_for_update().get(id=activity_id)
+            except model.DoesNotExist:
+                return  # cannot find activity
+            activity.remain_tickets += 1
+            activity.save()
+
+
+class ConditionalUpdateTicketInventory(TicketInventory):
+    """
+    UPDATE ... SET remain_tickets = remain_tickets - 1 WHERE id = ? AND remain_tickets > 0
+    The row is locked only for the statement itself, the affected row count tells whether it succeeded.
+    """
+
+    def decrease(self, model, activity_id):
+        return model.objects.filter(id=activity_id, remain_tickets__gt=0).update(
+            remain_tickets=F('remain_tickets') - 1
+        ) > 0
+
+    def increase(self, model, activity_id):
+        model.objects.filter(id=activity_id).update(remain_tickets=F('remain_tickets') + 1)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+import logging
+import threading
+import time
+
+from django.db import connection
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+
+from wechat.inventory import LockingTicketInventory, ConditionalUpdateTicketInventory
+from wechat.models import Activity
+
+
+__author__ = "Epsirom"
+
+
+class Command(BaseCommand):
+    help = 'Measure bookings/sec of ticket inventory backends under contention'
+
+    logger = logging.getLogger('benchinventory')
+
+    backends = [
+        ('locking', LockingTicketInventory),
+        ('conditional-update', ConditionalUpdateTicketInventory),
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=32, help='Concurrent bookers')
+        parser.add_argument('--tickets', type=int, default=2000, help='Tickets to sell in each round')
+        parser.add_argument('--rounds', type=int, default=3, help='Rounds for each backend')
+
+    def create_activity(self, tickets):
+        now = timezone.now()
+        return Activity.objects.create(
+            name='benchinventory', key='benchinventory-%d' % int(time.time() * 1000), description='',
+            start_time=now, end_time=now, place='', book_start=now, book_end=now,
+            total_tickets=tickets, status=Activity.STATUS_SAVED, pic_url='', remain_tickets=tickets,
+        )
+
+    def run_round(self, inventory, threads, tickets):
+        activity = self.create_activity(tickets)
+        booked = [0] * threads
+        start_barrier = threading.Barrier(threads + 1)
+
+        def booker(idx):
+            try:
+                start_barrier.wait()
+                while inventory.decrease(Activity, activity.id):
+                    booked[idx] += 1
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=booker, args=(i, )) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        start_barrier.wait()
+        begin = time.time()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - begin
+        remain = Activity.objects.get(id=activity.id).remain_tickets
+        activity.delete()
+        if sum(booked) != tickets or remain != 0:
+            self.logger.error('Oversold or lost tickets: booked %d of %d, %d remained', sum(booked), tickets, remain)
+        return elapsed
+
+    def handle(self, *args, **options):
+        threads = options['threads']
+        tickets = options['tickets']
+        self.logger.info('Selling %d tickets to %d threads, %d rounds each', tickets, threads, options['rounds'])
+        self.logger.info('=' * 32)
+        for name, backend in self.backends:
+            inventory = backend()
+            elapsed = [self.run_round(inventory, threads, tickets) for _ in range(options['rounds'])]
+            best = min(elapsed)
+            self.logger.info('%-20s %10.1f bookings/sec (best of %d, %.3fs)',
+                             name, tickets / best if best else float('inf'), len(elapsed), best)
+
+
+Command.logger.setLevel(logging.DEBUG)
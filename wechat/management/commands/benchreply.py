@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+#
+import logging
+import timeit
+
+from django.template.loader import get_template
+from django.core.management.base import BaseCommand
+
+from wechat import reply
+
+
+__author__ = "Epsirom"
+
+
+class Command(BaseCommand):
+    help = 'Compare the cost of building passive replies with templates and with the reply serializer'
+
+    logger = logging.getLogger('benchreply')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=2000, help='Replies built in each measurement')
+
+    def handle(self, *args, **options):
+        number = options['number']
+        context = {'ToUserName': 'o' * 28, 'FromUserName': 'gh_' + '0' * 12}
+        content = '对不起，没有找到您需要的信息:('
+        articles = [{
+            'Title': '活动%d' % i,
+            'Description': '活动简介' * 20,
+            'PicUrl': 'http://your.domain/img/%d.png' % i,
+            'Url': 'http://your.domain/u/activity?id=%d' % i,
+        } for i in range(8)]
+        cases = [
+            ('text.xml', lambda: get_template('text.xml').render(dict(context, Content=content))),
+            ('text serializer', lambda: reply.text_reply(context['ToUserName'], context['FromUserName'], content)),
+            ('news.xml', lambda: get_template('news.xml').render(dict(context, Articles=articles))),
+            ('news serializer', lambda: reply.news_reply(context['ToUserName'], context['FromUserName'], articles)),
+        ]
+        self.logger.info('Building each reply %d times, 8 articles in news', number)
+        self.logger.info('=' * 32)
+        for name, func in cases:
+            best = min(timeit.repeat(func, number=number, repeat=3))
+            self.logger.info('%-16s %8.1f us/reply', name, best / number * 1e6)
+
+
+Command.logger.setLevel(logging.DEBUG)
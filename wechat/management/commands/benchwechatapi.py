@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+import logging
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from wechat.fakeapi import FakeWeChatApi, wechat_lib_using
+from wechat.wrapper import WeChatLib, WeChatError
+
+
+__author__ = "Epsirom"
+
+
+class Command(BaseCommand):
+    help = 'Measure customer service messages/sec sent by WeChatLib to a fake WeChat API'
+
+    logger = logging.getLogger('benchwechatapi')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16, help='Concurrent senders')
+        parser.add_argument('--calls', type=int, default=2000, help='Messages to send')
+        parser.add_argument('--connections', type=int, default=10, help='Connections in the pool of WeChatLib')
+        parser.add_argument('--latency', type=float, default=0.005, help='Seconds the fake API takes for a call')
+        parser.add_argument('--error-rate', type=float, default=0, help='Fraction of calls failing')
+        parser.add_argument('--token-ttl', type=int, default=7200, help='expires_in of access tokens')
+        parser.add_argument('--api-root', default=None, help='Call this server instead of starting a fake one')
+
+    def run(self, threads, calls):
+        lib = WeChatLib('', 'appid', 'secret')
+        remaining = [calls]
+        failures = [0]
+        lock = threading.Lock()
+
+        def sender():
+            while True:
+                with lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+                try:
+                    lib.send_custom_message('openid', 'text', {'content': 'benchmark'})
+                except (WeChatError, OSError):
+                    with lock:
+                        failures[0] += 1
+
+        workers = [threading.Thread(target=sender) for _ in range(threads)]
+        begin = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return time.time() - begin, failures[0]
+
+    def handle(self, *args, **options):
+        api = None
+        api_root = options['api_root']
+        if api_root is None:
+            api = FakeWeChatApi(latency=options['latency'], error_rate=options['error_rate'],
+                                token_ttl=options['token_ttl']).start()
+            api_root = api.url
+        try:
+            with wechat_lib_using(api_root, options['connections']) as http:
+                elapsed, failures = self.run(options['threads'], options['calls'])
+            self.logger.info('Sent %d messages with %d threads over %d connections',
+                             options['calls'], options['threads'], options['connections'])
+            self.logger.info('=' * 32)
+            self.logger.info('%.1f calls/sec, %d failed', options['calls'] / elapsed if elapsed else 0, failures)
+            self.logger.info('p50 <= %ss, p99 <= %ss, mean %.4fs', http.histogram.percentile(50),
+                             http.histogram.percentile(99), http.histogram.snapshot()['mean'])
+            if api is not None:
+                self.logger.info('Fake API saw %d connections, %d token fetches',
+                                 api.counts['connections'], api.counts['/cgi-bin/token'])
+        finally:
+            if api is not None:
+                api.stop()
+
+
+Command.logger.setLevel(logging.DEBUG)
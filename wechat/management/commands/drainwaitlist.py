@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+#
+import logging
+
+from django.core.management.base import BaseCommand
+
+from wechat.views import CustomWeChatView
+from wechat.models import Activity, WaitlistEntry
+from wechat.notification import notify_entries
+
+
+__author__ = "Epsirom"
+
+
+class Command(BaseCommand):
+    help = 'Assign cancelled tickets to waitlisted students and notify them'
+
+    logger = logging.getLogger('drainwaitlist')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Students assigned or notified in each batch')
+
+    def handle(self, *args, **options):
+        for activity in Activity.objects.filter(status=Activity.STATUS_PUBLISHED, waitlist_open=True):
+            assigned = WaitlistEntry.drain(activity, options['batch_size'])
+            self.logger.info('Assigned %d tickets of %s (%d)', len(assigned), activity.name, activity.id)
+        notified = notify_entries(CustomWeChatView.lib, WaitlistEntry.objects.filter(
+            status=WaitlistEntry.STATUS_ASSIGNED
+        ), 'waitlist_assigned', options['batch_size'])
+        self.logger.info('Notified %d students', notified)
+
+
+Command.logger.setLevel(logging.DEBUG)
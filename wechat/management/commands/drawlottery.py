@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+#
+import logging
+
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+
+from wechat.views import CustomWeChatView
+from wechat.models import Activity, LotteryEntry
+from wechat.notification import notify_entries
+
+
+__author__ = "Epsirom"
+
+
+class Command(BaseCommand):
+    help = 'Draw lottery activities whose booking has ended and notify the winners'
+
+    logger = logging.getLogger('drawlottery')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Winners notified in each batch')
+
+    def draw(self):
+        activities = Activity.objects.filter(
+            status=Activity.STATUS_PUBLISHED, book_mode=Activity.BOOK_MODE_LOTTERY, book_end__lte=timezone.now(),
+            lotteryentry__status=LotteryEntry.STATUS_PENDING,
+        ).distinct()
+        for activity in activities:
+            winners = LotteryEntry.draw(activity)
+            self.logger.info('Drew %d winners for %s (%d)', len(winners), activity.name, activity.id)
+
+    def notify(self, batch_size):
+        notified = notify_entries(CustomWeChatView.lib, LotteryEntry.objects.filter(status=LotteryEntry.STATUS_WON),
+                                  'lottery_won', batch_size)
+        self.logger.info('Notified %d winners', notified)
+
+    def handle(self, *args, **options):
+        self.draw()
+        self.notify(options['batch_size'])
+
+
+Command.logger.setLevel(logging.DEBUG)
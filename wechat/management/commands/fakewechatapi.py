@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+#
+import logging
+
+from django.core.management.base import BaseCommand
+
+from wechat.fakeapi import FakeWeChatApi
+
+
+__author__ = "Epsirom"
+
+
+class Command(BaseCommand):
+    help = 'Serve a stand-in for the WeChat API, set WECHAT_API_ROOT to its address to use it'
+
+    logger = logging.getLogger('fakewechatapi')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8081)
+        parser.add_argument('--latency', type=float, nargs='+', default=[0],
+                            help='Seconds added to every call, or a min and max')
+        parser.add_argument('--error-rate', type=float, default=0, help='Fraction of calls failing with errcode -1')
+        parser.add_argument('--token-ttl', type=int, default=7200, help='expires_in of access tokens')
+
+    def handle(self, *args, **options):
+        latency = options['latency']
+        api = FakeWeChatApi(options['host'], options['port'], latency=latency if len(latency) > 1 else latency[0],
+                            error_rate=options['error_rate'], token_ttl=options['token_ttl'])
+        self.logger.info('Serving fake WeChat API at %s', api.url)
+        try:
+            api.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            api.server.server_close()
+            self.logger.info('Calls served: %s', ', '.join('%s=%d' % item for item in sorted(api.counts.items())))
+
+
+Command.logger.setLevel(logging.DEBUG)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+#
+import logging
+
+from django.core.management.base import BaseCommand
+
+from wechat.models import Activity, ActivityStatistics
+
+
+__author__ = "Epsirom"
+
+
+class Command(BaseCommand):
+    help = 'Rebuild ticket statistics of activities from their tickets'
+
+    logger = logging.getLogger('reconcilestats')
+
+    def add_arguments(self, parser):
+        parser.add_argument('activity_ids', nargs='*', type=int, help='Activities to check, all if omitted')
+
+    def handle(self, *args, **options):
+        activity_ids = options['activity_ids'] or Activity.objects.values_list('id', flat=True)
+        fixed = 0
+        for activity_id in activity_ids:
+            deltas = ActivityStatistics.reconcile(activity_id)
+            if deltas:
+                fixed += 1
+                self.logger.warn('Activity %d was off by %s', activity_id,
+                                 ', '.join('%s %+d' % item for item in sorted(deltas.items())))
+        self.logger.info('Checked %d activities, fixed %d', len(activity_ids), fixed)
+
+
+Command.logger.setLevel(logging.DEBUG)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Attendee manifest of an activity for gate devices without network, all integers big-endian:
+
+    header   4s magic b'WTFM', B format (1), B kind (0 full, 1 delta), B hash size (8), B bloom hash count k,
+             I activity id, Q version, Q since (0 for a full manifest), I record count, I bloom size in bytes
+    bloom    bloom size bytes, bit i of the filter is bit (i % 8) of byte i // 8
+    records  record count of (hash size bytes ticket hash, B status), sorted by hash
+
+The ticket hash is the first 8 bytes of SHA-256 of '<ticket id>.<activity id>', both read in clear from the
+ticket token of the QR code ('<ticket id>.<activity id>.<student id>:<signature>'). Bloom positions of a hash are
+(h1 + i * h2) % bits for i < k, h1 and h2 being its first and last 4 bytes (h2 | 1).
+A full manifest holds valid (1) and used (2) tickets. A delta holds every ticket changed after `since`,
+cancelled (0) ones included, and overlaps the previous version by a little, applying it twice is harmless.
+Versions are microseconds since the epoch at which the manifest was built.
+"""
+import bisect
+import datetime
+import hashlib
+import struct
+import time
+
+from django.utils import timezone
+
+from wechat.models import Ticket
+
+
+__author__ = "Epsirom"
+
+
+MAGIC = b'WTFM'
+FORMAT = 2
+KIND_FULL = 0
+KIND_DELTA = 1
+HASH_SIZE = 8
+RECORD = struct.Struct('>%dsB' % (HASH_SIZE, ))
+HEADER = struct.Struct('>4sBBBBIQQII')
+
+bloom_bits_per_ticket = 10
+bloom_hashes = 7
+
+# seconds a delta reaches back before `since`, for check-ins committed after the manifest was built
+delta_overlap = 60
+
+
+def ticket_hash(ticket_id, activity_id):
+    return hashlib.sha256(('%d.%d' % (ticket_id, activity_id)).encode('utf-8')).digest()[:HASH_SIZE]
+
+
+def token_ticket(token):
+    """
+    What a gate device reads from a scanned ticket token, without the secret to check its signature
+    :return: (ticket id, activity id), None if not a ticket token
+    """
+    try:
+        ticket_id, activity_id = token.rsplit(Ticket.token_signer.sep, 1)[0].split('.', 2)[:2]
+        return int(ticket_id), int(activity_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def bloom_positions(h, bits, k):
+    h1 = int.from_bytes(h[:4], 'big')
+    h2 = int.from_bytes(h[-4:], 'big') | 1
+    return [(h1 + i * h2) % bits for i in range(k)]
+
+
+def build_bloom(hashes, k=bloom_hashes):
+    size = max((len(hashes) * bloom_bits_per_ticket + 7) // 8, 8)
+    bloom = bytearray(size)
+    for h in hashes:
+        for position in bloom_positions(h, size * 8, k):
+            bloom[position // 8] |= 1 << (position % 8)
+    return bytes(bloom)
+
+
+def current_version():
+    return int(time.time() * 1000000)
+
+
+def build(activity_id, since=None):
+    """
+    :param since: version of the manifest the device has, None for a full manifest
+    :return: (manifest bytes, version)
+    """
+    version = current_version()
+    tickets = Ticket.objects.filter(activity_id=activity_id)
+    if since is None:
+        tickets = tickets.filter(status__in=(Ticket.STATUS_VALID, Ticket.STATUS_USED))
+    else:
+        reach = datetime.datetime.fromtimestamp(max(since / 1000000.0 - delta_overlap, 0), timezone.utc)
+        tickets = tickets.filter(modified_time__gte=reach).exclude(status=Ticket.STATUS_UNCLAIMED)
+    records = sorted((ticket_hash(ticket_id, activity_id), status)
+                     for ticket_id, status in tickets.values_list('id', 'status').iterator())
+    bloom = build_bloom([h for h, _ in records])
+    header = HEADER.pack(MAGIC, FORMAT, KIND_FULL if since is None else KIND_DELTA, HASH_SIZE, bloom_hashes,
+                         activity_id, version, since or 0, len(records), len(bloom))
+    return b''.join([header, bloom] + [RECORD.pack(h, status) for h, status in records]), version
+
+
+class Manifest(object):
+    """
+    Reader of a manifest, e.g. over an mmap, looking tickets up by binary search as a gate device would
+    """
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        magic, fmt, self.kind, hash_size, self.k, self.activity_id, self.version, self.since, self.count, \
+            bloom_size = HEADER.unpack_from(self.data)
+        if magic != MAGIC or fmt != FORMAT or hash_size != HASH_SIZE:
+            raise ValueError('Not a ticket manifest of format %d' % (FORMAT, ))
+        self.bloom = self.data[HEADER.size:HEADER.size + bloom_size]
+        self.offset = HEADER.size + bloom_size
+        if len(self.data) != self.offset + self.count * RECORD.size:
+            raise ValueError('Truncated ticket manifest')
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return RECORD.unpack_from(self.data, self.offset + index * RECORD.size)
+
+    def might_contain(self, h):
+        bits = len(self.bloom) * 8
+        return all(self.bloom[p // 8] & (1 << (p % 8)) for p in bloom_positions(h, bits, self.k))
+
+    def lookup(self, token):
+        """
+        :param token: scanned ticket token
+        :return: status of the ticket, None if not in the manifest
+        """
+        scanned = token_ticket(token)
+        if scanned is None or scanned[1] != self.activity_id:
+            return None
+        h = ticket_hash(*scanned)
+        if not self.might_contain(h):
+            return None
+        hashes = _HashView(self)
+        index = bisect.bisect_left(hashes, h)
+        if index < self.count and hashes[index] == h:
+            return self[index][1]
+        return None
+
+
+class _HashView(object):
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def __getitem__(self, index):
+        return self.manifest[index][0]
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+import copy
+import logging
+import threading
+
+from django.core.cache import cache
+
+
+__author__ = "Epsirom"
+
+
+class MenuSync(object):
+    """
+    Custom menu kept in CACHES: `desired` is the latest menu asked for, `pushed` the one WeChat has.
+    update() records the desired menu and pushes it `delay` seconds later, so that a burst of edits ends in one
+    push, and nothing is pushed when the desired menu is the pushed one.
+    A delayed push failing in the timer thread is kept under `error_key` for pop_error() until a push succeeds.
+    """
+    logger = logging.getLogger('WeChat')
+
+    desired_key = 'wechat:menu:desired'
+    pushed_key = 'wechat:menu:pushed'
+    error_key = 'wechat:menu:error'
+
+    def __init__(self, lib, delay=2):
+        """
+        :type lib: wechat.wrapper.WeChatLib
+        """
+        self.lib = lib
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.push_lock = threading.Lock()
+        self.timer = None
+
+    def current(self):
+        """
+        Menu as it is once pending pushes are done, loaded from WeChat only if it is not known here
+        """
+        menu = cache.get(self.desired_key) or cache.get(self.pushed_key)
+        if menu is None:
+            menu = {'button': self.lib.get_wechat_menu()}
+            cache.set(self.pushed_key, menu, None)
+        return menu
+
+    def update(self, menu):
+        """
+        :return: True if the menu has been pushed, False if unchanged or the push is delayed
+        """
+        cache.set(self.desired_key, copy.deepcopy(menu), None)
+        if self.delay <= 0:
+            return self.flush()
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.delay, self.flush_quietly)
+            self.timer.daemon = True
+            self.timer.start()
+        return False
+
+    def flush(self):
+        """
+        Push the desired menu now if it differs from the pushed one
+        :return: True if pushed
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        with self.push_lock:
+            menu = cache.get(self.desired_key)
+            pushed = cache.get(self.pushed_key)
+            if menu is None or menu == pushed:
+                self.logger.debug('Menu unchanged, not pushed')
+                return False
+            self.logger.info('Pushing menu: %s', ', '.join(self.diff(pushed, menu)) or 'layout changed')
+            self.lib.set_wechat_menu(menu)
+            cache.set(self.pushed_key, menu, None)
+            cache.delete(self.error_key)
+            return True
+
+    def flush_quietly(self):
+        """
+        Delayed push in the timer thread, where nobody is waiting for the error
+        """
+        try:
+            self.flush()
+        except Exception as e:
+            self.logger.exception('Failed to push menu, it will be pushed with the next update')
+            cache.set(self.error_key, str(e), None)
+
+    def pop_error(self):
+        """
+        :return: error of the last delayed push if it failed since asked last time, None otherwise
+        """
+        error = cache.get(self.error_key)
+        if error is not None:
+            cache.delete(self.error_key)
+        return error
+
+    @staticmethod
+    def diff(old, new):
+        """
+        :return: list of '+name' and '-name' for buttons added to or removed from the menu
+        """
+        def names(menu):
+            result = list()
+            for btn in (menu or {}).get('button', []):
+                for sub in btn.get('sub_button', []):
+                    result.append('%s/%s' % (btn.get('name'), sub.get('name')))
+                if not btn.get('sub_button'):
+                    result.append(btn.get('name'))
+            return result
+
+        old_names, new_names = names(old), names(new)
+        return ['-' + name for name in old_names if name not in new_names] + \
+               ['+' + name for name in new_names if name not in old_names]
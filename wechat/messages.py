@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+import os
+import re
+import threading
+
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+from WeChatTicket import settings
+from codex.cache import LRUCache
+
+
+__author__ = "Epsirom"
+
+
+class MessageCatalogue(object):
+    """
+    templates/messages/* compiled once per process.
+    Messages without any tag are kept as constants, and messages rendered with nothing but an activity are
+    memoized by (name, activity id, activity version).
+    """
+
+    tag_pattern = re.compile(r'{[{%](.*?)[%}]}', re.S)
+    name_pattern = re.compile(r'[A-Za-z_]\w*')
+
+    def __init__(self, directory=os.path.join(settings.BASE_DIR, 'templates', 'messages'),
+                 implicit_names=('handler', 'user')):
+        self.directory = directory
+        self.implicit_names = set(implicit_names)
+        self.lock = threading.Lock()
+        self.messages = None
+        self.fragments = LRUCache(maxsize=4096)
+
+    def compile(self, name, source):
+        """
+        :return: (render callable taking a context dict, whether the message uses implicit names)
+        """
+        tags = self.tag_pattern.findall(source)
+        if not tags:
+            constant = mark_safe(source)
+            return (lambda context: constant), False
+        template = get_template('messages/' + name + '.html')
+        names = set(self.name_pattern.findall(' '.join(tags)))
+        return template.render, bool(names & self.implicit_names)
+
+    def load(self):
+        messages = dict()
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.html'):
+                with open(os.path.join(self.directory, filename), encoding='utf-8') as f:
+                    messages[filename[: -5]] = self.compile(filename[: -5], f.read())
+        self.messages = messages
+
+    def get(self, name):
+        if self.messages is None:
+            with self.lock:
+                if self.messages is None:
+                    self.load()
+        message = self.messages.get(name)
+        if message is None:  # not in the directory, e.g. added after loading
+            return get_template('messages/' + name + '.html').render, True
+        return message
+
+    def render(self, name, data, implicit=None):
+        """
+        :param data: variables given by the caller
+        :param implicit: variables always available to messages, e.g. handler and user
+        """
+        if name.endswith('.html'):
+            name = name[: -5]
+        render, uses_implicit = self.get(name)
+        activity = data.get('activity')
+        if activity is None or len(data) != 1 or uses_implicit:
+            return render(dict(implicit or {}, **data))
+        key = (name, activity.id, activity.version)
+        result = self.fragments.get(key)
+        if result is None:
+            result = render(dict(data))
+            self.fragments.set(key, result)
+        return result
+
+    def clear(self):
+        self.fragments.clear()
+
+
+catalogue = MessageCatalogue()
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2026-10-18 08:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat', '0003_auto_20181016_1650'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='ticket_pool',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterIndexTogether(
+            name='ticket',
+            index_together=set([('activity', 'status')]),
+        ),
+    ]
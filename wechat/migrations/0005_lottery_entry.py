@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2026-10-18 08:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat', '0004_ticket_pool'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LotteryEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('student_id', models.CharField(max_length=32)),
+                ('status', models.IntegerField(default=0)),
+                ('notified', models.BooleanField(default=False)),
+                ('created_time', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='book_mode',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='lotteryentry',
+            name='activity',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wechat.Activity'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='lotteryentry',
+            unique_together=set([('activity', 'student_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='lotteryentry',
+            index_together=set([('activity', 'status')]),
+        ),
+    ]
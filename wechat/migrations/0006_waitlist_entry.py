@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2026-10-18 08:56
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat', '0005_lottery_entry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WaitlistEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('student_id', models.CharField(max_length=32)),
+                ('status', models.IntegerField(default=0)),
+                ('notified', models.BooleanField(default=False)),
+                ('created_time', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='activity',
+            name='waitlist_open',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='waitlistentry',
+            name='activity',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wechat.Activity'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='waitlistentry',
+            unique_together=set([('activity', 'student_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='waitlistentry',
+            index_together=set([('activity', 'status', 'created_time')]),
+        ),
+    ]
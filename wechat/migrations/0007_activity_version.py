@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2026-10-18 08:59
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat', '0006_waitlist_entry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2026-10-18 09:11
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def count_existing_tickets(apps, schema_editor):
+    Ticket = apps.get_model('wechat', 'Ticket')
+    ActivityStatistics = apps.get_model('wechat', 'ActivityStatistics')
+    stats = dict()
+    for activity_id, status, count in Ticket.objects.exclude(status=-1).values_list(
+            'activity_id', 'status').annotate(models.Count('id')):
+        row = stats.setdefault(activity_id, ActivityStatistics(activity_id=activity_id, shard=0))
+        row.booked += count
+        if status == 0:
+            row.cancelled += count
+        elif status == 2:
+            row.used += count
+    ActivityStatistics.objects.bulk_create(stats.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat', '0007_activity_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.IntegerField()),
+                ('booked', models.IntegerField(default=0)),
+                ('cancelled', models.IntegerField(default=0)),
+                ('used', models.IntegerField(default=0)),
+                ('activity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wechat.Activity')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='activitystatistics',
+            unique_together=set([('activity', 'shard')]),
+        ),
+        migrations.RunPython(count_existing_tickets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2026-10-18 09:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat', '0008_activity_statistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='used_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
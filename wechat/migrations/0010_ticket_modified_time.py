@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2026-10-18 10:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat', '0009_ticket_used_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='modified_time',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AlterIndexTogether(
+            name='ticket',
+            index_together=set([('activity', 'modified_time'), ('activity', 'status')]),
+        ),
+    ]
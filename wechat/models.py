@@ -1,14 +1,61 @@
+import collections
+import logging
+import random
 import uuid
 
-from django.db import models, transaction
+from django.core import signing
+from django.core.cache import cache
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
 
 from codex.baseerror import LogicError
+from codex.cache import LRUCache
+from wechat.inventory import ConditionalUpdateTicketInventory
 
 
 class User(models.Model):
     open_id = models.CharField(max_length=64, unique=True, db_index=True)
     student_id = models.CharField(max_length=32, unique=False, db_index=True)
 
+    # open_id -> (id, student_id, version) of bound users in this process, checked against the version
+    # in CACHES so that an unbinding in any process shows up at once
+    cache = LRUCache(maxsize=10000, ttl=60)
+    version_key = 'wechat:user:%s:version'
+
+    def save(self, *args, **kwargs):
+        super(User, self).save(*args, **kwargs)
+        self.cache.delete(self.open_id)
+        cache.set(self.version_key % (self.open_id, ), uuid.uuid4().hex, None)
+
+    @classmethod
+    def get_version(cls, openid):
+        key = cls.version_key % (openid, )
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, uuid.uuid4().hex, None)
+            version = cache.get(key)
+        return version
+
+    @classmethod
+    def get_or_create_cached(cls, openid):
+        """
+        Bound users are cached so that they cost no query, unbound users are always loaded
+        so that a binding made by another process shows up at once.
+        :return: User, with only id, open_id and student_id when it comes from cache
+        """
+        version = cls.get_version(openid)
+        cached = cls.cache.get(openid)
+        if cached is not None and cached[2] == version:
+            return cls(id=cached[0], open_id=openid, student_id=cached[1])
+        user, created = cls.objects.get_or_create(open_id=openid)
+        if created:
+            logging.getLogger('WeChat').info('New user: %s', user.open_id)
+        if user.student_id:
+            cls.cache.set(openid, (user.id, user.student_id, version))
+        return user
+
     @classmethod
     def get_by_openid(cls, openid):
         try:
@@ -50,11 +97,23 @@ class Activity(models.Model):
     status = models.IntegerField()
     pic_url = models.CharField(max_length=256)
     remain_tickets = models.IntegerField()
+    ticket_pool = models.BooleanField(default=False)
+    book_mode = models.IntegerField(default=0)
+    waitlist_open = models.BooleanField(default=False)
+    version = models.IntegerField(default=0)
 
     STATUS_DELETED = -1
     STATUS_SAVED = 0
     STATUS_PUBLISHED = 1
 
+    BOOK_MODE_FIRST_COME = 0
+    BOOK_MODE_LOTTERY = 1
+
+    # changes whenever any activity is created, edited or deleted, shared by all processes
+    list_version_key = 'wechat:activity:list_version'
+
+    inventory = ConditionalUpdateTicketInventory()
+
     @classmethod
     def get_by_activity_id(cls, activity_id):
         try:
@@ -69,28 +128,44 @@ class Activity(models.Model):
         except cls.DoesNotExist:
             raise LogicError('Activity not found')
 
+    def save(self, *args, **kwargs):
+        if kwargs.get('update_fields') is None:
+            self.version += 1  # rendered fragments of this activity are memoized by version
+        super(Activity, self).save(*args, **kwargs)
+
+    @classmethod
+    def get_list_version(cls):
+        version = cache.get(cls.list_version_key)
+        if version is None:
+            cache.add(cls.list_version_key, uuid.uuid4().hex, None)
+            version = cache.get(cls.list_version_key)
+        return version
+
+    @classmethod
+    def bump_list_version(cls):
+        cache.set(cls.list_version_key, uuid.uuid4().hex, None)
+
+    def get_remain_tickets(self):
+        """
+        Activities with a pre-allocated ticket pool derive the count from the unclaimed tickets
+        """
+        if self.ticket_pool:
+            return Ticket.objects.filter(activity=self, status=Ticket.STATUS_UNCLAIMED).count()
+        return self.remain_tickets
+
     @classmethod
     def decrease_ticket_exclusive(cls, activity_id):
-        with transaction.atomic():
-            try:
-                activity = cls.objects.select_for_update().get(id=activity_id)
-            except cls.DoesNotExist:
-                return False  # cannot find activity, book fail
-            if activity.remain_tickets <= 0:
-                return False  # no ticket remained
-            activity.remain_tickets -= 1
-            activity.save()
-            return True  # book ticket success
+        return cls.inventory.decrease(cls, activity_id)
 
     @classmethod
     def increase_ticket_exclusive(cls, activity_id):
-        with transaction.atomic():
-            try:
-                activity = cls.objects.select_for_update().get(id=activity_id)
-            except cls.DoesNotExist:
-                return  # cannot find activity, book fail
-            activity.remain_tickets += 1
-            activity.save()
+        cls.inventory.increase(cls, activity_id)
+
+
+@receiver(post_save, sender=Activity)
+@receiver(post_delete, sender=Activity)
+def activity_changed(sender, **kwargs):
+    Activity.bump_list_version()
 
 
 class Ticket(models.Model):
@@ -98,25 +173,472 @@ class Ticket(models.Model):
     unique_id = models.CharField(max_length=64, db_index=True, unique=True)
     activity = models.ForeignKey(Activity)
     status = models.IntegerField()
+    used_time = models.DateTimeField(null=True, blank=True)
+    # set by save(), and by hand in update() calls, for the deltas of wechat.manifest
+    modified_time = models.DateTimeField(auto_now=True)
 
+    STATUS_UNCLAIMED = -1
     STATUS_CANCELLED = 0
     STATUS_VALID = 1
     STATUS_USED = 2
 
+    # number of unclaimed tickets to pick from, so that concurrent claims rarely hit the same row
+    claim_window = 16
+
+    # valid tickets of a student are cached under this key until one of them changes
+    valid_list_key = 'wechat:tickets:%s'
+    valid_list_timeout = 300
+
+    # tokens are '<id>.<activity id>.<student id>:<signature>' signed with SECRET_KEY
+    token_signer = signing.Signer(salt='wechat.Ticket.token')
+
+    class Meta:
+        index_together = [
+            ['activity', 'status'],
+            ['activity', 'modified_time'],
+        ]
+
     def assign_uuid(self):
         res = uuid.uuid3(uuid.NAMESPACE_URL, str(uuid.uuid4()) + str(self.id))
         self.unique_id = str(res)
 
+    def issue_token(self):
+        """
+        Token proving the ticket is the student's, checked by verify_token without the database
+        """
+        return self.token_signer.sign('%d.%d.%s' % (self.id, self.activity_id, self.student_id))
+
+    @classmethod
+    def is_token(cls, value):
+        return isinstance(value, str) and cls.token_signer.sep in value
+
+    @classmethod
+    def verify_token(cls, token):
+        """
+        :return: (ticket id, activity id, student id), None if the token is forged or malformed
+        """
+        try:
+            ticket_id, activity_id, student_id = cls.token_signer.unsign(token).split('.', 2)
+            return int(ticket_id), int(activity_id), student_id
+        except (signing.BadSignature, TypeError, ValueError):
+            return None
+
     @classmethod
     def create_ticket(cls, student_id, activity):
         ticket = Ticket(student_id=student_id, activity=activity, status=Ticket.STATUS_VALID)  # default status is valid
         ticket.assign_uuid()
         ticket.save()
+        ActivityStatistics.record(activity.id, booked=1)
         return ticket
 
+    @classmethod
+    def create_unclaimed(cls, activity):
+        ticket = Ticket(student_id='', activity=activity, status=Ticket.STATUS_UNCLAIMED)
+        ticket.assign_uuid()
+        return ticket
+
+    @classmethod
+    def allocate_pool(cls, activity):
+        """
+        Make the unclaimed tickets of activity match total_tickets, called when an activity is published or edited
+        :return: number of unclaimed tickets
+        """
+        with transaction.atomic():
+            list(Activity.objects.select_for_update().filter(id=activity.id).values_list('id'))  # serialize allocation
+            counts = dict(cls.objects.filter(activity=activity).values_list('status').annotate(models.Count('id')))
+            issued = counts.get(cls.STATUS_VALID, 0) + counts.get(cls.STATUS_USED, 0)
+            unclaimed = counts.get(cls.STATUS_UNCLAIMED, 0)
+            missing = int(activity.total_tickets) - issued - unclaimed
+            if missing > 0:
+                cls.objects.bulk_create([cls.create_unclaimed(activity) for _ in range(missing)], batch_size=500)
+            elif missing < 0:
+                extra = list(cls.objects.filter(
+                    activity=activity, status=cls.STATUS_UNCLAIMED
+                ).values_list('id', flat=True)[: min(-missing, unclaimed)])
+                cls.objects.filter(id__in=extra, status=cls.STATUS_UNCLAIMED).delete()
+            Activity.objects.filter(id=activity.id).update(ticket_pool=True)
+            activity.ticket_pool = True
+            return max(unclaimed + missing, 0)
+
+    @classmethod
+    def claim_ticket(cls, student_id, activity):
+        """
+        Hand one unclaimed ticket of activity to student_id with a single conditional UPDATE
+        :return: the claimed Ticket, None if no ticket remained
+        """
+        while True:
+            candidates = list(cls.objects.filter(
+                activity=activity, status=cls.STATUS_UNCLAIMED
+            ).values_list('id', 'unique_id')[: cls.claim_window])
+            if not candidates:
+                return None  # no ticket remained
+            ticket_id, unique_id = random.choice(candidates)
+            if cls.objects.filter(id=ticket_id, status=cls.STATUS_UNCLAIMED).update(
+                    student_id=student_id, status=cls.STATUS_VALID, modified_time=timezone.now()):
+                cls.forget_valid_lists(student_id)
+                ActivityStatistics.record(activity.id, booked=1)
+                return Ticket(id=ticket_id, unique_id=unique_id, student_id=student_id, activity=activity,
+                              status=cls.STATUS_VALID)
+            # somebody else claimed it first, try again
+
+    @classmethod
+    def book_ticket(cls, student_id, activity):
+        """
+        :return: the booked Ticket, None if sold out
+        """
+        if activity.ticket_pool:
+            return cls.claim_ticket(student_id, activity)
+        if not Activity.decrease_ticket_exclusive(activity.id):
+            return None
+        return cls.create_ticket(student_id=student_id, activity=activity)
+
+    @classmethod
+    def book_tickets(cls, student_ids, activity):
+        """
+        Book for a group of students in one transaction: one counter update (or one claim) and one bulk insert
+        :return: dict of student_id -> Ticket, students left out are sold out
+        """
+        student_ids = list(collections.OrderedDict.fromkeys(student_ids))
+        if not student_ids:
+            return {}
+        with transaction.atomic():
+            if activity.ticket_pool:
+                rows = list(cls.objects.select_for_update().filter(
+                    activity=activity, status=cls.STATUS_UNCLAIMED
+                ).values_list('id', 'unique_id')[: len(student_ids)])
+                tickets = [Ticket(id=ticket_id, unique_id=unique_id, student_id=student_id, activity=activity,
+                                  status=cls.STATUS_VALID)
+                           for (ticket_id, unique_id), student_id in zip(rows, student_ids)]
+                if tickets:
+                    cls.objects.filter(id__in=[t.id for t in tickets]).update(
+                        student_id=models.Case(
+                            *[models.When(id=t.id, then=models.Value(t.student_id)) for t in tickets],
+                            output_field=models.CharField()
+                        ),
+                        status=cls.STATUS_VALID,
+                        modified_time=timezone.now(),
+                    )
+            else:
+                remain = Activity.objects.select_for_update().filter(
+                    id=activity.id
+                ).values_list('remain_tickets', flat=True).first() or 0
+                granted = max(min(remain, len(student_ids)), 0)
+                tickets = [Ticket(student_id=student_id, activity=activity, status=cls.STATUS_VALID)
+                           for student_id in student_ids[: granted]]
+                if tickets:
+                    Activity.objects.filter(id=activity.id).update(remain_tickets=models.F('remain_tickets') - granted)
+                    for ticket in tickets:
+                        ticket.assign_uuid()
+                    cls.objects.bulk_create(tickets)
+                    # bulk_create leaves the ids unset on MySQL and sqlite, read them back for links and tokens
+                    ids = dict(cls.objects.filter(
+                        unique_id__in=[t.unique_id for t in tickets]
+                    ).values_list('unique_id', 'id'))
+                    for ticket in tickets:
+                        ticket.id = ids[ticket.unique_id]
+            if tickets:
+                ActivityStatistics.record(activity.id, booked=len(tickets))
+        cls.forget_valid_lists(*[ticket.student_id for ticket in tickets])
+        return {ticket.student_id: ticket for ticket in tickets}
+
+    @classmethod
+    def cancel_ticket(cls, ticket, activity):
+        """
+        Cancel a valid ticket and give it back to the activity
+        :return: False if the ticket is not valid any more
+        """
+        if not cls.objects.filter(id=ticket.id, status=cls.STATUS_VALID).update(
+                status=cls.STATUS_CANCELLED, modified_time=timezone.now()):
+            return False
+        ticket.status = cls.STATUS_CANCELLED
+        cls.forget_valid_lists(ticket.student_id)
+        ActivityStatistics.record(activity.id, cancelled=1)
+        if activity.ticket_pool:
+            cls.create_unclaimed(activity).save()
+        else:
+            Activity.increase_ticket_exclusive(activity.id)
+        return True
+
+    @classmethod
+    def check_in(cls, activity, scans):
+        """
+        Check in a batch of scans at the door of activity with one locked read and one UPDATE
+        :param scans: list of (unique_id, student_id, scanned time), one of unique_id and student_id being None
+        :return: list of (unique_id, student_id, result) for each scan, result being one of
+                 'accepted', 'used', 'rejected' (cancelled or not a ticket of activity) and 'noticket'
+        """
+        unique_ids = [scan[0] for scan in scans if scan[0] is not None]
+        student_ids = [scan[1] for scan in scans if scan[0] is None]
+        with transaction.atomic():
+            rows = list(cls.objects.select_for_update().filter(activity=activity).filter(
+                models.Q(unique_id__in=unique_ids) | models.Q(student_id__in=student_ids)
+            ).exclude(status=cls.STATUS_UNCLAIMED).values_list('id', 'unique_id', 'student_id', 'status'))
+            by_unique_id = {row[1]: row for row in rows}
+            by_student_id = dict()
+            for row in rows:
+                if row[2] not in by_student_id or row[3] == cls.STATUS_VALID:  # prefer the valid ticket
+                    by_student_id[row[2]] = row
+            used = dict()  # ticket id -> (student_id, used_time)
+            results = list()
+            for unique_id, student_id, scanned in scans:
+                row = by_unique_id.get(unique_id) if unique_id is not None else by_student_id.get(student_id)
+                if row is None:
+                    results.append((unique_id, student_id, 'rejected' if unique_id is not None else 'noticket'))
+                    continue
+                ticket_id, unique_id, student_id, status = row
+                if status == cls.STATUS_VALID and ticket_id not in used:
+                    used[ticket_id] = (student_id, scanned)
+                    result = 'accepted'
+                elif status == cls.STATUS_USED or ticket_id in used:
+                    result = 'used'
+                else:
+                    result = 'rejected'
+                results.append((unique_id, student_id, result))
+            if used:
+                cls.objects.filter(id__in=list(used), status=cls.STATUS_VALID).update(
+                    status=cls.STATUS_USED,
+                    used_time=models.Case(
+                        *[models.When(id=ticket_id, then=models.Value(scanned))
+                          for ticket_id, (_, scanned) in used.items()],
+                        output_field=models.DateTimeField()
+                    ),
+                    modified_time=timezone.now(),
+                )
+                ActivityStatistics.record(activity.id, used=len(used))
+        cls.forget_valid_lists(*[student_id for student_id, _ in used.values()])
+        return results
+
+    @classmethod
+    def get_valid_list(cls, student_id, limit):
+        """
+        Valid tickets of student_id in published activities, with their activities loaded in the same query.
+        The list is cached until a ticket of the student or any activity changes.
+        :return: list of Ticket, at most limit
+        """
+        key = cls.valid_list_key % student_id
+        version = Activity.get_list_version()
+        cached = cache.get(key)
+        if cached is not None and cached[:2] == (version, limit):
+            return cached[2]
+        tickets = list(cls.objects.filter(
+            status=cls.STATUS_VALID, student_id=student_id, activity__status=Activity.STATUS_PUBLISHED
+        ).select_related('activity').order_by('id')[: limit])
+        cache.set(key, (version, limit, tickets), cls.valid_list_timeout)
+        return tickets
+
+    @classmethod
+    def forget_valid_lists(cls, *student_ids):
+        keys = [cls.valid_list_key % student_id for student_id in student_ids if student_id]
+        if keys:
+            cache.delete_many(keys)
+
     @classmethod
     def get_by_ticket_unique_id(cls, ticket_unique_id):
         try:
             return cls.objects.get(unique_id=ticket_unique_id)
         except cls.DoesNotExist:
             raise LogicError('Ticket not found')
+
+
+class ActivityStatistics(models.Model):
+    """
+    Ticket counts of an activity, split over `shards` rows picked at random so that concurrent bookings
+    rarely wait for the same row. booked counts every ticket handed out, including the cancelled and used ones.
+    """
+    activity = models.ForeignKey(Activity)
+    shard = models.IntegerField()
+    booked = models.IntegerField(default=0)
+    cancelled = models.IntegerField(default=0)
+    used = models.IntegerField(default=0)
+
+    shards = 8
+    fields = ('booked', 'cancelled', 'used')
+
+    class Meta:
+        unique_together = [
+            ['activity', 'shard'],
+        ]
+
+    @classmethod
+    def record(cls, activity_id, shard=None, **deltas):
+        """
+        Add deltas, e.g. record(activity.id, booked=1), in the transaction of the change counted
+        """
+        if shard is None:
+            shard = random.randrange(cls.shards)
+        changes = {k: models.F(k) + v for k, v in deltas.items() if v}
+        if not changes:
+            return
+        if cls.objects.filter(activity_id=activity_id, shard=shard).update(**changes):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(activity_id=activity_id, shard=shard, **deltas)
+        except IntegrityError:  # created by someone else meanwhile
+            cls.objects.filter(activity_id=activity_id, shard=shard).update(**changes)
+
+    @classmethod
+    def get_for(cls, activity_id):
+        """
+        :return: dict of booked, cancelled and used
+        """
+        totals = cls.objects.filter(activity_id=activity_id).aggregate(
+            **{k: models.Sum(k) for k in cls.fields}
+        )
+        return {k: totals[k] or 0 for k in cls.fields}
+
+    @classmethod
+    def count_tickets(cls, activity_id):
+        """
+        :return: dict of booked, cancelled and used, counted from tickets with one aggregate query
+        """
+        counts = dict(Ticket.objects.filter(activity_id=activity_id).exclude(
+            status=Ticket.STATUS_UNCLAIMED
+        ).values_list('status').annotate(models.Count('id')))
+        return {
+            'booked': sum(counts.values()),
+            'cancelled': counts.get(Ticket.STATUS_CANCELLED, 0),
+            'used': counts.get(Ticket.STATUS_USED, 0),
+        }
+
+    @classmethod
+    def reconcile(cls, activity_id):
+        """
+        Make the counts of activity match its tickets. Existing rows are locked first, so that changes committed
+        meanwhile are either counted in both or added after.
+        :return: dict of the corrections made
+        """
+        with transaction.atomic():
+            rows = list(cls.objects.select_for_update().filter(activity_id=activity_id).values_list(*cls.fields))
+            recorded = {k: sum(row[i] for row in rows) for i, k in enumerate(cls.fields)}
+            actual = cls.count_tickets(activity_id)
+            deltas = {k: actual[k] - recorded[k] for k in cls.fields}
+            cls.record(activity_id, shard=0, **deltas)
+            return {k: v for k, v in deltas.items() if v}
+
+
+@receiver(post_save, sender=Ticket)
+@receiver(post_delete, sender=Ticket)
+def ticket_changed(sender, instance, **kwargs):
+    Ticket.forget_valid_lists(instance.student_id)
+
+
+class LotteryEntry(models.Model):
+    activity = models.ForeignKey(Activity)
+    student_id = models.CharField(max_length=32)
+    status = models.IntegerField(default=0)
+    notified = models.BooleanField(default=False)
+    created_time = models.DateTimeField(auto_now_add=True)
+
+    STATUS_PENDING = 0
+    STATUS_WON = 1
+    STATUS_LOST = 2
+
+    class Meta:
+        unique_together = [
+            ['activity', 'student_id'],
+        ]
+        index_together = [
+            ['activity', 'status'],
+        ]
+
+    @classmethod
+    def enter(cls, student_id, activity):
+        """
+        :return: False if the student has entered the lottery already
+        """
+        try:
+            with transaction.atomic():
+                cls.objects.create(activity=activity, student_id=student_id)
+        except IntegrityError:
+            return False
+        return True
+
+    @classmethod
+    def draw(cls, activity):
+        """
+        Pick winners among pending entries of activity and book their tickets in one pass
+        :return: list of student_id of winners
+        """
+        with transaction.atomic():
+            entries = dict(cls.objects.select_for_update().filter(
+                activity=activity, status=cls.STATUS_PENDING
+            ).values_list('student_id', 'id'))
+            if not entries:
+                return []
+            tickets = max(Activity.objects.get(id=activity.id).get_remain_tickets(), 0)
+            winners = random.sample(list(entries.keys()), min(tickets, len(entries)))
+            booked = Ticket.book_tickets(winners, activity)
+            cls.objects.filter(id__in=[entries[student_id] for student_id in booked]).update(status=cls.STATUS_WON)
+            cls.objects.filter(activity=activity, status=cls.STATUS_PENDING).update(status=cls.STATUS_LOST)
+            return list(booked.keys())
+
+
+class WaitlistEntry(models.Model):
+    activity = models.ForeignKey(Activity)
+    student_id = models.CharField(max_length=32)
+    status = models.IntegerField(default=0)
+    notified = models.BooleanField(default=False)
+    created_time = models.DateTimeField()
+
+    STATUS_WAITING = 0
+    STATUS_ASSIGNED = 1
+    STATUS_SKIPPED = 2
+
+    class Meta:
+        unique_together = [
+            ['activity', 'student_id'],
+        ]
+        index_together = [
+            ['activity', 'status', 'created_time'],
+        ]
+
+    @classmethod
+    def enter(cls, student_id, activity):
+        """
+        Append student_id to the waitlist of activity, and stop first-come booking until the waitlist is drained
+        :return: position in the waitlist, None if the student is waiting already
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            entry, created = cls.objects.select_for_update().get_or_create(
+                activity=activity, student_id=student_id, defaults={'created_time': now}
+            )
+            if not created:
+                if entry.status == cls.STATUS_WAITING:
+                    return None
+                entry.status = cls.STATUS_WAITING  # waiting again, e.g. after cancelling an assigned ticket
+                entry.notified = False
+                entry.created_time = now
+                entry.save()
+        Activity.objects.filter(id=activity.id, waitlist_open=False).update(waitlist_open=True)
+        return cls.objects.filter(
+            activity=activity, status=cls.STATUS_WAITING, created_time__lte=entry.created_time
+        ).count()
+
+    @classmethod
+    def drain(cls, activity, batch_size=100):
+        """
+        Assign freed tickets of activity to the head of its waitlist, batch_size students per transaction.
+        The waitlist is closed once nobody is waiting.
+        :return: list of student_id assigned
+        """
+        assigned = list()
+        while True:
+            with transaction.atomic():
+                head = list(cls.objects.select_for_update().filter(
+                    activity=activity, status=cls.STATUS_WAITING
+                ).order_by('created_time', 'id').values_list('id', 'student_id')[: batch_size])
+                if not head:
+                    Activity.objects.filter(id=activity.id).update(waitlist_open=False)
+                    return assigned
+                holders = set(Ticket.objects.filter(
+                    activity=activity, status=Ticket.STATUS_VALID, student_id__in=[s for _, s in head]
+                ).values_list('student_id', flat=True))
+                cls.objects.filter(id__in=[i for i, s in head if s in holders]).update(status=cls.STATUS_SKIPPED)
+                head = [(i, s) for i, s in head if s not in holders]
+                booked = Ticket.book_tickets([s for _, s in head], activity)
+                cls.objects.filter(id__in=[i for i, s in head if s in booked]).update(status=cls.STATUS_ASSIGNED)
+                assigned += list(booked.keys())
+                if len(booked) < len(head):
+                    return assigned  # no freed ticket left
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+#
+import logging
+
+from wechat.messages import catalogue
+from wechat.models import User
+
+
+__author__ = "Epsirom"
+
+
+logger = logging.getLogger('WeChat')
+
+
+def notify_entries(lib, entries, template_name, batch_size=100):
+    """
+    Send a customer service message to the students of entries, batch_size entries at a time.
+    Entries are LotteryEntry / WaitlistEntry, their notified flag is set with one UPDATE per batch.
+    :param lib: WeChatLib
+    :param entries: QuerySet of entries not notified yet
+    :return: number of entries notified
+    """
+    model = entries.model
+    total = 0
+    while True:
+        batch = list(entries.filter(notified=False).select_related('activity').order_by('id')[: batch_size])
+        if not batch:
+            return total
+        openids = dict(User.objects.filter(
+            student_id__in=[entry.student_id for entry in batch]
+        ).values_list('student_id', 'open_id'))
+        done = list()
+        for entry in batch:
+            openid = openids.get(entry.student_id)
+            try:
+                if openid:
+                    lib.send_custom_message(openid, 'text', {
+                        'content': catalogue.render(template_name, {'activity': entry.activity}),
+                    })
+                done.append(entry.id)  # users who unbound meanwhile cannot be notified
+            except Exception:
+                logger.exception('Failed to notify %s of activity %d', entry.student_id, entry.activity_id)
+        model.objects.filter(id__in=done).update(notified=True)
+        total += len(done)
+        logger.info('Notified %d of %d students', len(done), len(batch))
+        if len(done) < len(batch):
+            return total  # retry failed ones in the next run
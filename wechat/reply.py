@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Passive reply XML built with string formatting, producing the same document as templates/text.xml and
+templates/news.xml: values are autoescaped the way the templates do (Url and PicUrl are not), and a "]]>"
+inside a value is split over two CDATA sections so that it cannot end the section early.
+"""
+import html
+import time
+import xml.etree.ElementTree as ET
+
+from django.utils.html import conditional_escape
+
+
+__author__ = "Epsirom"
+
+
+def cdata(value, escape=True):
+    if value is None:
+        value = ''
+    if escape:
+        value = conditional_escape(value)
+    return '<![CDATA[' + str(value).replace(']]>', ']]]]><![CDATA[>') + ']]>'
+
+
+def envelope(to_user, from_user, msg_type, content):
+    return ''.join((
+        '<xml><ToUserName>', cdata(to_user), '</ToUserName><FromUserName>', cdata(from_user),
+        '</FromUserName><CreateTime>', str(int(time.time())), '</CreateTime><MsgType>', cdata(msg_type),
+        '</MsgType>', content, '</xml>',
+    ))
+
+
+def text_reply(to_user, from_user, content):
+    return envelope(to_user, from_user, 'text', '<Content>' + cdata(content) + '</Content>')
+
+
+def news_reply(to_user, from_user, articles):
+    items = ''.join(
+        '<item><Title>%s</Title><Description>%s</Description><PicUrl>%s</PicUrl><Url>%s</Url></item>' % (
+            cdata(article.get('Title')), cdata(article.get('Description')),
+            cdata(article.get('PicUrl'), False), cdata(article.get('Url'), False),
+        ) for article in articles
+    )
+    return envelope(to_user, from_user, 'news', '<ArticleCount>%d</ArticleCount><Articles>%s</Articles>' % (
+        len(articles), items
+    ))
+
+
+def custom_message(reply):
+    """
+    Convert a passive reply into the msgtype and content of a customer service message with the same content,
+    text unescaped as the JSON API shows it verbatim
+    :return: (msg_type, content), None if the reply is empty or not a text or news reply
+    """
+    if not reply or reply == 'success':
+        return None
+    root = ET.fromstring(reply)
+    msg_type = root.findtext('MsgType')
+    if msg_type == 'text':
+        return 'text', {'content': html.unescape(root.findtext('Content') or '')}
+    elif msg_type == 'news':
+        return 'news', {'articles': [{
+            'title': html.unescape(item.findtext('Title') or ''),
+            'description': html.unescape(item.findtext('Description') or ''),
+            'url': item.findtext('Url') or '',
+            'picurl': item.findtext('PicUrl') or '',
+        } for item in root.iter('item')]}
+    return None
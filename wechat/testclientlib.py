@@ -1,3 +1,5 @@
+import contextlib
+
 from django.template.loader import get_template
 from django.test import Client
 import xml.etree.ElementTree as ET
@@ -5,6 +7,7 @@ import xml.etree.ElementTree as ET
 from django.utils import timezone
 
 from WeChatTicket import settings
+from wechat.fakeapi import FakeWeChatApi, wechat_lib_using
 
 
 class WechatTestClientLib(Client):
@@ -57,3 +60,15 @@ class WechatTestClientLib(Client):
         if msg_type_root is None:
             return ''
         return msg_type_root.text
+
+
+@contextlib.contextmanager
+def fake_wechat_api(max_connections=10, timeout=5, **options):
+    """
+    Run a FakeWeChatApi with options and make WeChatLib call it, e.g.
+        with fake_wechat_api(token_ttl=1) as api:
+            CustomWeChatView.lib.get_wechat_menu()
+    """
+    with FakeWeChatApi(**options) as api, wechat_lib_using(api.url, max_connections, timeout) as http:
+        api.http = http
+        yield api
@@ -1,16 +1,43 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
 from django.template.loader import get_template
 from django.test import TestCase
+from django.utils.safestring import mark_safe
 
 # Create your tests here.
+from WeChatTicket import settings
+from codex.asgi import AsgiRouter, WsgiBridge
 from dateutil.parser import parse as parse_time
 
-from wechat.models import User, Activity, Ticket
-from wechat.testclientlib import WechatTestClientLib
+from wechat import reply
+from wechat.coordinator import BookingCoordinator
+from wechat.menusync import MenuSync
+from wechat.messages import catalogue
+from wechat.inventory import LockingTicketInventory, ConditionalUpdateTicketInventory
+from wechat.models import User, Activity, Ticket, LotteryEntry, WaitlistEntry, ActivityStatistics
+from wechat.testclientlib import WechatTestClientLib, fake_wechat_api
+from wechat.tokenstore import FileTokenStore
 from wechat.views import CustomWeChatView
+from wechat.handlers import HelpOrSubscribeHandler, SnapUpTicketHandler, LookUpTicketHandler, BookWhatHandler
+from wechat.wrapper import WeChatHandler, WeChatLib, WeChatError
 
 
 class WechatBaseTest(TestCase):
     def setUp(self):
+        cache.clear()
+        User.cache.clear()
+        catalogue.clear()
+        BookWhatHandler.snapshot = None
         User.objects.create(
             open_id='921E1460FD86481C9087C7E2A9B7C6322967F79BDFC34ED2873EFC8106EDC38A',
             student_id='2016012345'
@@ -120,6 +147,43 @@ class BookWhatTest(WechatBaseTest):
         self.activity_map['7e'].save()
 
 
+class BookWhatSnapshotTest(WechatBaseTest):
+
+    def send_book_what(self):
+        resp = self.wechat_server.send_click(CustomWeChatView.event_keys['book_what'],
+                                             'B72AAF5F26554351B768642D7618ECCE42EA2BEEA9DE4B108E59744CFC028044')
+        return [article['Title'] for article in self.wechat_server.get_news(resp)]
+
+    def test_served_from_snapshot(self):
+        self.wechat_server.mock_timezone_now(parse_time('2018-10-18 00:00:00 UTC'))
+        self.assertEqual(self.send_book_what(), [self.activity_map['7e'].name])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.send_book_what(), [self.activity_map['7e'].name])
+
+    def test_rebuilt_on_change(self):
+        self.wechat_server.mock_timezone_now(parse_time('2018-10-18 00:00:00 UTC'))
+        self.send_book_what()
+        act = self.activity_map['21']
+        act.status = Activity.STATUS_PUBLISHED
+        act.save()
+        self.assertEqual(self.send_book_what(), [self.activity_map['7e'].name, act.name], 'published one shows up')
+
+        self.wechat_server.mock_timezone_now(parse_time('2018-10-19 01:00:00 UTC'))
+        self.assertEqual(self.send_book_what(), [act.name], 'rebuilt after the first one crossed book_end')
+
+        act.delete()
+        self.assertEqual(self.send_book_what(), [])
+
+    def test_limit(self):
+        self.wechat_server.mock_timezone_now(parse_time('2018-10-18 00:00:00 UTC'))
+        act = self.activity_map['7e']
+        for i in range(10):
+            act.pk = None
+            act.key = str(i)
+            act.save()
+        self.assertEqual(len(self.send_book_what()), WeChatHandler.article_limit)
+
+
 class SnapUpTicketTest(WechatBaseTest):
     def setUp(self):
         super().setUp()
@@ -215,8 +279,9 @@ class SnapUpTicketTest(WechatBaseTest):
 
         resp = self.wechat_server.send_text('抢票 ' + self.activity_map['7e'].key,
                                             '921E1460FD86481C9087C7E2A9B7C6322967F79BDFC34ED2873EFC8106EDC38A')
-        self.assertEqual(self.wechat_server.get_text(resp), get_template('messages/sold_out.html').render(),
-                         'no ticket, other user should fail')
+        self.assertEqual(self.wechat_server.get_text(resp), get_template('messages/sold_out.html').render({
+            'activity': self.activity_map['7e']
+        }), 'no ticket, other user should fail')
 
         # restore
         self.wechat_server.send_text('退票' + self.activity_map['7e'].key,
@@ -393,6 +458,34 @@ class LookUpTicketTest(WechatBaseTest):
         resp = self.wechat_server.send_click(CustomWeChatView.event_keys['get_ticket'], user_open_id)
         self.assertEqual(self.wechat_server.get_text(resp), get_template('messages/ticket_empty.html').render())
 
+    def test_cached_until_tickets_change(self):
+        user_open_id = '921E1460FD86481C9087C7E2A9B7C6322967F79BDFC34ED2873EFC8106EDC38A'
+        ticket = Ticket.create_ticket(student_id='2016012345', activity=self.activity_map['7e'])
+        Ticket.create_ticket(student_id='2016012345', activity=self.activity_map['8d'])
+
+        with self.assertNumQueries(2):  # user and tickets with their activities
+            resp = self.wechat_server.send_click(CustomWeChatView.event_keys['get_ticket'], user_open_id)
+        self.assertEqual(len(self.wechat_server.get_news(resp)), 1)
+        with self.assertNumQueries(0):
+            resp = self.wechat_server.send_click(CustomWeChatView.event_keys['get_ticket'], user_open_id)
+        self.assertEqual(len(self.wechat_server.get_news(resp)), 1)
+
+        Ticket.cancel_ticket(ticket, self.activity_map['7e'])
+        resp = self.wechat_server.send_click(CustomWeChatView.event_keys['get_ticket'], user_open_id)
+        self.assertEqual(self.wechat_server.get_text(resp), get_template('messages/ticket_empty.html').render())
+
+        Ticket.book_tickets(['2016012345'], self.activity_map['7e'])
+        resp = self.wechat_server.send_click(CustomWeChatView.event_keys['get_ticket'], user_open_id)
+        self.assertEqual(len(self.wechat_server.get_news(resp)), 1)
+
+    def test_limited_to_article_limit(self):
+        user_open_id = '921E1460FD86481C9087C7E2A9B7C6322967F79BDFC34ED2873EFC8106EDC38A'
+        for _ in range(LookUpTicketHandler.article_limit + 2):
+            Ticket.create_ticket(student_id='2016012345', activity=self.activity_map['7e'])
+
+        resp = self.wechat_server.send_click(CustomWeChatView.event_keys['get_ticket'], user_open_id)
+        self.assertEqual(len(self.wechat_server.get_news(resp)), LookUpTicketHandler.article_limit)
+
 
 class WithdrawTicketTest(WechatBaseTest):
 
@@ -428,3 +521,684 @@ class WithdrawTicketTest(WechatBaseTest):
         self.wechat_server.send_text('退票 ' + self.activity_map['7e'].key, user_open_id)
         resp = self.wechat_server.send_text('取票 ' + self.activity_map['7e'].key, user_open_id)
         self.assertEqual(self.wechat_server.get_text(resp), get_template('messages/no_ticket_in_hand.html').render())
+
+
+class TicketInventoryTest(WechatBaseTest):
+
+    def check_inventory(self, inventory):
+        act = self.activity_map['7e']
+        act.remain_tickets = 2
+        act.save()
+        self.assertTrue(inventory.decrease(Activity, act.id))
+        self.assertTrue(inventory.decrease(Activity, act.id))
+        self.assertFalse(inventory.decrease(Activity, act.id), 'no ticket remained, decrease should fail')
+        self.assertEqual(Activity.objects.get(id=act.id).remain_tickets, 0)
+
+        inventory.increase(Activity, act.id)
+        self.assertEqual(Activity.objects.get(id=act.id).remain_tickets, 1)
+        self.assertFalse(inventory.decrease(Activity, -5), 'activity not found, decrease should fail')
+
+    def test_locking_inventory(self):
+        self.check_inventory(LockingTicketInventory())
+
+    def test_conditional_update_inventory(self):
+        self.check_inventory(ConditionalUpdateTicketInventory())
+
+
+class TicketPoolTest(WechatBaseTest):
+    def setUp(self):
+        super().setUp()
+        self.activity_map['7e'].total_tickets = 1
+        self.activity_map['7e'].save()
+        Ticket.allocate_pool(self.activity_map['7e'])
+
+    def test_allocate_pool(self):
+        act = self.activity_map['7e']
+        self.assertEqual(Ticket.objects.filter(activity=act, status=Ticket.STATUS_UNCLAIMED).count(), 1)
+        self.assertEqual(Activity.objects.get(id=act.id).get_remain_tickets(), 1)
+
+        act.total_tickets = 3
+        act.save()
+        self.assertEqual(Ticket.allocate_pool(act), 3, 'pool should grow with total_tickets')
+        act.total_tickets = 2
+        act.save()
+        self.assertEqual(Ticket.allocate_pool(act), 2, 'pool should shrink with total_tickets')
+        self.assertEqual(Ticket.allocate_pool(act), 2, 'allocation should be idempotent')
+
+    def test_claim_and_cancel(self):
+        user_a = '921E1460FD86481C9087C7E2A9B7C6322967F79BDFC34ED2873EFC8106EDC38A'
+        user_b = '48A3CB2513F049A98A7DFD2453ED717296F3D2B76DC7407DB3886D5F4F4B5C04'
+        act = self.activity_map['7e']
+        self.wechat_server.mock_timezone_now(parse_time('2018-10-19 00:00:00 UTC'))
+
+        resp = self.wechat_server.send_click(CustomWeChatView.event_keys['book_header'] + str(act.id), user_a)
+        self.assertEqual(len(self.wechat_server.get_news(resp)), 1)
+        ticket = Ticket.objects.get(activity=act, student_id='2016012345', status=Ticket.STATUS_VALID)
+        self.assertEqual(Ticket.objects.filter(activity=act).count(), 1, 'booking should claim the pooled ticket')
+        self.assertIn(urllib.parse.quote(ticket.issue_token()), self.wechat_server.get_news(resp)[0]['Url'])
+
+        resp = self.wechat_server.send_text('抢票 ' + act.key, user_b)
+        self.assertEqual(self.wechat_server.get_text(resp), get_template('messages/sold_out.html').render({
+            'activity': act
+        }))
+
+        resp = self.wechat_server.send_text('退票 ' + act.key, user_a)
+        self.assertEqual(self.wechat_server.get_text(resp), get_template('messages/cancel_complete.html').render({
+            'activity': act
+        }))
+        self.assertEqual(Activity.objects.get(id=act.id).get_remain_tickets(), 1, 'cancelled ticket goes back')
+
+        resp = self.wechat_server.send_text('抢票 ' + act.key, user_b)
+        self.assertEqual(len(self.wechat_server.get_news(resp)), 1)
+        self.assertNotEqual(Ticket.objects.get(student_id='2018000000', activity=act).unique_id, ticket.unique_id,
+                            'a released ticket should not reuse the cancelled unique id')
+
+
+class BookingCoordinatorTest(WechatBaseTest):
+    def setUp(self):
+        super().setUp()
+        self.activity_map['7e'].remain_tickets = 2
+        self.activity_map['7e'].save()
+
+    def test_book_tickets_counter(self):
+        act = self.activity_map['7e']
+        booked = Ticket.book_tickets(['2016012345', '2018000000', '2016012345', '2019000000'], act)
+        self.assertEqual(sorted(booked.keys()), ['2016012345', '2018000000'], 'first come first served in a batch')
+        self.assertEqual(Activity.objects.get(id=act.id).remain_tickets, 0)
+        self.assertEqual(Ticket.objects.filter(activity=act, status=Ticket.STATUS_VALID).count(), 2)
+        self.assertEqual(Ticket.book_tickets(['2019000000'], act), {}, 'sold out')
+
+    def test_book_tickets_pool(self):
+        act = self.activity_map['7e']
+        act.total_tickets = 2
+        act.save()
+        Ticket.allocate_pool(act)
+        booked = Ticket.book_tickets(['2016012345', '2018000000', '2019000000'], act)
+        self.assertEqual(sorted(booked.keys()), ['2016012345', '2018000000'])
+        for student_id, ticket in booked.items():
+            self.assertEqual(Ticket.objects.get(unique_id=ticket.unique_id).student_id, student_id)
+        self.assertEqual(act.get_remain_tickets(), 0)
+
+    def test_coordinator(self):
+        act = self.activity_map['7e']
+        coordinator = BookingCoordinator(window=0.001)
+        ticket = coordinator.book('2016012345', act)
+        self.assertEqual(Ticket.objects.get(unique_id=ticket.unique_id).student_id, '2016012345')
+        self.assertIsNotNone(coordinator.book('2018000000', act))
+        self.assertIsNone(coordinator.book('2019000000', act), 'sold out')
+        self.assertEqual(coordinator.pending, {}, 'finished batches should be removed')
+
+    def test_snap_up_batched(self):
+        act = self.activity_map['7e']
+        self.wechat_server.mock_timezone_now(parse_time('2018-10-19 00:30:00 UTC'))
+        with mock.patch.object(CustomWeChatView, 'booking', BookingCoordinator(window=0.001)):
+            resp = self.wechat_server.send_text('抢票 ' + act.key, '921E1460FD86481C9087C7E2A9B7C6322967F79BDFC34ED2873EFC8106EDC38A')
+        self.assertEqual(self.wechat_server.get_msg_type(resp), 'news')
+        ticket = Ticket.objects.get(activity=act, student_id='2016012345')
+        self.assertIn(urllib.parse.quote(ticket.issue_token()), self.wechat_server.get_news(resp)[0]['Url'])
+
+
+class LotteryTest(WechatBaseTest):
+    def setUp(self):
+        super().setUp()
+        self.activity_map['7e'].book_mode = Activity.BOOK_MODE_LOTTERY
+        self.activity_map['7e'].remain_tickets = 1
+        self.activity_map['7e'].save()
+
+    def test_enter_and_draw(self):
+        user_a = '921E1460FD86481C9087C7E2A9B7C6322967F79BDFC34ED2873EFC8106EDC38A'
+        user_b = '48A3CB2513F049A98A7DFD2453ED717296F3D2B76DC7407DB3886D5F4F4B5C04'
+        act = self.activity_map['7e']
+        self.wechat_server.mock_timezone_now(parse_time('2018-10-19 00:30:00 UTC'))
+
+        resp = self.wechat_server.send_text('抢票 ' + act.key, user_a)
+        self.assertEqual(self.wechat_server.get_text(resp), get_template('messages/lottery_entered.html').render({
+            'activity': act
+        }))
+        resp = self.wechat_server.send_text('抢票 ' + act.key, user_a)
+        self.assertEqual(self.wechat_server.get_text(resp),
+                         get_template('messages/lottery_already_entered.html').render({'activity': act}))
+        self.wechat_server.send_click(CustomWeChatView.event_keys['book_header'] + str(act.id), user_b)
+        self.assertEqual(LotteryEntry.objects.filter(activity=act).count(), 2)
+        self.assertEqual(Ticket.objects.filter(activity=act).count(), 0, 'no ticket before the draw')
+
+        self.wechat_server.mock_timezone_now(parse_time('2018-10-19 01:00:01 UTC'))
+        with mock.patch.object(CustomWeChatView.lib, 'send_custom_message') as send:
+            call_command('drawlottery')
+            call_command('drawlottery')  # drawn activities are left alone
+        self.assertEqual(send.call_count, 1, 'only the winner is notified, and only once')
+
+        winner = LotteryEntry.objects.get(activity=act, status=LotteryEntry.STATUS_WON)
+        self.assertTrue(winner.notified)
+        self.assertEqual(LotteryEntry.objects.filter(activity=act, status=LotteryEntry.STATUS_LOST).count(), 1)
+        self.assertEqual(Ticket.objects.get(activity=act, status=Ticket.STATUS_VALID).student_id, winner.student_id)
+        self.assertEqual(Activity.objects.get(id=act.id).remain_tickets, 0)
+
+
+class WaitlistTest(WechatBaseTest):
+    def setUp(self):
+        super().setUp()
+        self.activity_map['7e'].remain_tickets = 1
+        self.activity_map['7e'].save()
+
+    def test_waitlist(self):
+        user_a = '921E1460FD86481C9087C7E2A9B7C6322967F79BDFC34ED2873EFC8106EDC38A'
+        user_b = '48A3CB2513F049A98A7DFD2453ED717296F3D2B76DC7407DB3886D5F4F4B5C04'
+        act = self.activity_map['7e']
+        self.wechat_server.mock_timezone_now(parse_time('2018-10-19 00:30:00 UTC'))
+
+        self.wechat_server.send_text('抢票 ' + act.key, user_a)
+        resp = self.wechat_server.send_text('抢票 ' + act.key, user_b)
+        self.assertEqual(self.wechat_server.get_text(resp), get_template('messages/sold_out.html').render({
+            'activity': act
+        }), 'sold out reply should offer the waitlist')
+
+        resp = self.wechat_server.send_text('候补 ' + act.key, user_a)
+        self.assertEqual(self.wechat_server.get_text(resp), get_template('messages/already_booked.html').render())
+        resp = self.wechat_server.send_text('候补 ' + act.key, user_b)
+        self.assertEqual(self.wechat_server.get_text(resp), get_template('messages/waitlist_entered.html').render({
+            'activity': act, 'position': 1
+        }))
+        resp = self.wechat_server.send_text('候补 ' + act.key, user_b)
+        self.assertEqual(self.wechat_server.get_text(resp),
+                         get_template('messages/waitlist_already_entered.html').render({'activity': act}))
+
+        self.wechat_server.send_text('退票 ' + act.key, user_a)
+        resp = self.wechat_server.send_text('抢票 ' + act.key, user_a)
+        self.assertEqual(self.wechat_server.get_text(resp), get_template('messages/sold_out.html').render({
+            'activity': act
+        }), 'a cancelled ticket is kept for the waitlist')
+
+        with mock.patch.object(CustomWeChatView.lib, 'send_custom_message') as send:
+            call_command('drainwaitlist')
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(Ticket.objects.get(activity=act, status=Ticket.STATUS_VALID).student_id, '2018000000')
+        entry = WaitlistEntry.objects.get(activity=act, student_id='2018000000')
+        self.assertEqual(entry.status, WaitlistEntry.STATUS_ASSIGNED)
+        self.assertTrue(entry.notified)
+        self.assertFalse(Activity.objects.get(id=act.id).waitlist_open, 'drained waitlist should be closed')
+
+    def test_waitlist_before_sold_out(self):
+        user_b = '48A3CB2513F049A98A7DFD2453ED717296F3D2B76DC7407DB3886D5F4F4B5C04'
+        act = self.activity_map['7e']
+        self.wechat_server.mock_timezone_now(parse_time('2018-10-18 23:59:59 UTC'))
+        resp = self.wechat_server.send_text('候补 ' + act.key, user_b)
+        self.assertEqual(self.wechat_server.get_text(resp), get_template('messages/book_not_start.html').render())
+
+        self.wechat_server.mock_timezone_now(parse_time('2018-10-19 00:30:00 UTC'))
+        resp = self.wechat_server.send_text('候补 ' + act.key, user_b)
+        self.assertEqual(self.wechat_server.get_text(resp),
+                         get_template('messages/waitlist_not_sold_out.html').render({'activity': act}))
+        self.assertFalse(Activity.objects.get(id=act.id).waitlist_open)
+        self.assertFalse(WaitlistEntry.objects.filter(activity=act).exists())
+
+        resp = self.wechat_server.send_text('抢票 ' + act.key, user_b)
+        self.assertEqual(self.wechat_server.get_msg_type(resp), 'news', 'first-come booking still works')
+        self.assertTrue(Ticket.objects.filter(activity=act, student_id='2018000000', status=Ticket.STATUS_VALID).exists())
+
+
+class RoutingTest(TestCase):
+
+    class QuestionHandler(WeChatHandler):
+
+        def check(self):
+            return self.is_msg_type('text') and self.input['Content'].endswith('?')
+
+        def handle(self):
+            return self.reply_text('?')
+
+    def test_declared_routes(self):
+        view = CustomWeChatView()
+        self.assertIsInstance(view.route({'MsgType': 'text', 'Content': 'HELP'}, None), HelpOrSubscribeHandler)
+        self.assertIsInstance(view.route({'MsgType': 'event', 'Event': 'subscribe'}, None), HelpOrSubscribeHandler)
+        self.assertIsInstance(view.route({'MsgType': 'text', 'Content': '抢票  key'}, None), SnapUpTicketHandler)
+        self.assertIsInstance(view.route({
+            'MsgType': 'event', 'Event': 'CLICK', 'EventKey': CustomWeChatView.event_keys['book_header'] + '12'
+        }, None), SnapUpTicketHandler)
+        self.assertIsInstance(view.route({
+            'MsgType': 'event', 'Event': 'CLICK', 'EventKey': CustomWeChatView.event_keys['get_ticket']
+        }, None), LookUpTicketHandler)
+        self.assertIsNone(view.route({'MsgType': 'text', 'Content': '抢票key'}, None))
+        self.assertIsNone(view.route({'MsgType': 'image'}, None))
+
+    def test_custom_predicate_fallback(self):
+        class QuestionView(CustomWeChatView):
+            handlers = [RoutingTest.QuestionHandler] + CustomWeChatView.handlers
+
+        self.assertEqual(QuestionView.route_fallbacks, [0])
+        view = QuestionView()
+        self.assertIsInstance(view.route({'MsgType': 'text', 'Content': '帮助?'}, None), RoutingTest.QuestionHandler)
+        self.assertIsInstance(view.route({'MsgType': 'text', 'Content': '帮助'}, None), HelpOrSubscribeHandler)
+
+
+class UserCacheTest(WechatBaseTest):
+
+    def test_bound_user_cached(self):
+        user_open_id = '921E1460FD86481C9087C7E2A9B7C6322967F79BDFC34ED2873EFC8106EDC38A'
+        self.wechat_server.send_click(CustomWeChatView.event_keys['help'], user_open_id)
+        with self.assertNumQueries(0):
+            resp = self.wechat_server.send_click(CustomWeChatView.event_keys['help'], user_open_id)
+        self.assertEqual(self.wechat_server.get_msg_type(resp), 'news')
+
+    def test_unbind_invalidates(self):
+        user_open_id = '921E1460FD86481C9087C7E2A9B7C6322967F79BDFC34ED2873EFC8106EDC38A'
+        resp = self.wechat_server.send_text('绑定', user_open_id)
+        self.assertIn('2016012345', self.wechat_server.get_text(resp))
+        self.wechat_server.send_text('解绑', user_open_id)
+        resp = self.wechat_server.send_text('绑定', user_open_id)
+        self.assertNotIn('2016012345', self.wechat_server.get_text(resp), 'unbound user should not stay cached')
+
+        User.bind_user_and_openid('2016012345', user_open_id)
+        resp = self.wechat_server.send_text('绑定', user_open_id)
+        self.assertIn('2016012345', self.wechat_server.get_text(resp))
+
+    def test_unbind_in_another_process(self):
+        user_open_id = '921E1460FD86481C9087C7E2A9B7C6322967F79BDFC34ED2873EFC8106EDC38A'
+        self.assertEqual(User.get_or_create_cached(user_open_id).student_id, '2016012345')
+        user = User.objects.get(open_id=user_open_id)
+        user.student_id = ''
+        with mock.patch.object(User.cache, 'delete'):  # the LRU of this process is left as it is
+            user.save()
+        self.assertEqual(User.get_or_create_cached(user_open_id).student_id, '')
+        resp = self.wechat_server.send_text('绑定', user_open_id)
+        self.assertNotIn('2016012345', self.wechat_server.get_text(resp))
+
+    def test_unbound_user_not_cached(self):
+        user_open_id = 'B72AAF5F26554351B768642D7618ECCE42EA2BEEA9DE4B108E59744CFC028044'
+        self.wechat_server.send_text('绑定', user_open_id)
+        User.objects.filter(open_id=user_open_id).update(student_id='2019000000')  # e.g. bound by another process
+        resp = self.wechat_server.send_text('绑定', user_open_id)
+        self.assertIn('2019000000', self.wechat_server.get_text(resp))
+
+
+class ReplySerializerTest(TestCase):
+
+    def parse(self, xml):
+        root = ET.fromstring(xml)
+        return {child.tag: child.text for child in root if child.tag not in ('CreateTime', 'Articles')}, [
+            {child.tag: child.text or '' for child in item} for item in root.iter('item')
+        ]
+
+    def test_same_as_templates(self):
+        context = {'ToUserName': 'to', 'FromUserName': 'from'}
+        content = get_template('messages/bind_account.html').render({})
+        self.assertEqual(self.parse(reply.text_reply('to', 'from', content)),
+                         self.parse(get_template('text.xml').render(dict(context, Content=content))))
+        self.assertEqual(self.parse(reply.text_reply('to', 'from', 'a < b & c')),
+                         self.parse(get_template('text.xml').render(dict(context, Content='a < b & c'))))
+
+        articles = [{'Title': 'T&T', 'Description': 'D', 'Url': 'http://a/?x=1&y=2'},
+                    {'Title': 'T', 'Description': 'D', 'Url': 'http://a', 'PicUrl': 'http://b/?p=1&q=2'}]
+        self.assertEqual(self.parse(reply.news_reply('to', 'from', articles)),
+                         self.parse(get_template('news.xml').render(dict(context, Articles=articles))))
+
+    def test_cdata_escape(self):
+        msg, _ = self.parse(reply.text_reply('to', 'from', mark_safe('x]]>y')))
+        self.assertEqual(msg['Content'], 'x]]>y')
+
+
+class MessageCatalogueTest(WechatBaseTest):
+
+    def test_same_as_templates(self):
+        act = self.activity_map['7e']
+        for name in ('activity_title', 'ticket_title', 'sold_out', 'book_empty', 'cancel_complete'):
+            self.assertEqual(catalogue.render(name, {'activity': act}),
+                             get_template('messages/%s.html' % name).render({'activity': act}))
+        self.assertEqual(catalogue.render('waitlist_entered', {'activity': act, 'position': 3}),
+                         get_template('messages/waitlist_entered.html').render({'activity': act, 'position': 3}))
+
+    def test_activity_fragments_memoized(self):
+        act = self.activity_map['7e']
+        title = catalogue.render('activity_title', {'activity': act})
+        self.assertIsNotNone(catalogue.fragments.get(('activity_title', act.id, act.version)))
+
+        act.name = 'renamed'
+        act.save()
+        self.assertNotEqual(catalogue.render('activity_title', {'activity': act}), title,
+                            'saving an activity should invalidate its fragments')
+        self.assertEqual(catalogue.render('activity_title', {'activity': act}), 'renamed')
+
+    def test_implicit_names_not_memoized(self):
+        user = User.objects.get(student_id='2016012345')
+        self.assertIn('2016012345', catalogue.render('bind_account', {'activity': self.activity_map['7e']}, {
+            'user': user, 'handler': None
+        }))
+        self.assertEqual(len(catalogue.fragments), 0)
+
+
+class AsgiEndpointTest(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(settings, 'IGNORE_WECHAT_SIGNATURE', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def call(app, method, path, query_string=b'', body=b''):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.get_event_loop().run_until_complete(app({
+            'type': 'http', 'method': method, 'path': path, 'query_string': query_string, 'headers': [],
+        }, receive, send))
+        return messages[0]['status'], b''.join(m.get('body', b'') for m in messages[1:])
+
+    def test_echostr(self):
+        status, body = self.call(CustomWeChatView.as_asgi(), 'GET', '/wechat', b'echostr=hello')
+        self.assertEqual((status, body), (200, b'hello'))
+
+    def test_handlers(self):
+        app = CustomWeChatView.as_asgi()
+        status, body = self.call(app, 'POST', '/wechat', body=get_template('user_text.xml').render({
+            'ToUserName': '', 'FromUserName': 'someone', 'Content': 'nothing matches this'
+        }).encode())
+        self.assertEqual(status, 200)
+        self.assertEqual(ET.fromstring(body).find('Content').text, '对不起，没有找到您需要的信息:(')
+
+        status, body = self.call(app, 'POST', '/wechat', body=get_template('user_text.xml').render({
+            'ToUserName': '', 'FromUserName': 'someone', 'Content': 'help'
+        }).encode())
+        self.assertEqual(ET.fromstring(body).find('MsgType').text, 'news', 'blocking handlers run in the pool')
+
+    def test_bad_signature(self):
+        with mock.patch.object(settings, 'IGNORE_WECHAT_SIGNATURE', False):
+            status, _ = self.call(CustomWeChatView.as_asgi(), 'GET', '/wechat', b'echostr=hello')
+        self.assertEqual(status, 404)
+
+    def test_wsgi_bridge(self):
+        def wsgi_app(environ, start_response):
+            start_response('201 Created', [('Content-Type', 'text/plain')])
+            yield environ['PATH_INFO'].encode()
+            yield environ['wsgi.input'].read()
+
+        router = AsgiRouter([(r'^/wechat/?$', CustomWeChatView.as_asgi())],
+                            fallback=WsgiBridge(wsgi_app, CustomWeChatView.executor, buffer_chunks=1))
+        self.assertEqual(self.call(router, 'POST', '/api/a/x', body=b'data'), (201, b'/api/a/xdata'))
+        self.assertEqual(self.call(router, 'GET', '/wechat', b'echostr=e'), (200, b'e'))
+
+
+class ReplyBudgetTest(TestCase):
+
+    def setUp(self):
+        self.wechat_server = WechatTestClientLib()
+
+    def send_help(self, delay):
+        original = HelpOrSubscribeHandler.handle
+
+        def slow_handle(handler):
+            time.sleep(delay)
+            return original(handler)
+
+        sent = threading.Event()
+        with mock.patch.object(settings, 'WECHAT_REPLY_BUDGET', 0.1), \
+                mock.patch.object(HelpOrSubscribeHandler, 'handle', slow_handle), \
+                mock.patch.object(CustomWeChatView.lib, 'send_custom_message', side_effect=lambda *a: sent.set()) as send:
+            resp = self.wechat_server.send_text('help', 'someone')
+            if resp.content == b'success':
+                sent.wait(5)
+        return resp, send
+
+    def test_in_budget(self):
+        resp, send = self.send_help(0)
+        self.assertEqual(self.wechat_server.get_msg_type(resp), 'news')
+        send.assert_not_called()
+
+    def test_out_of_budget(self):
+        resp, send = self.send_help(0.3)
+        self.assertEqual(resp.content, b'success')
+        send.assert_called_once_with('someone', 'news', mock.ANY)
+        self.assertEqual(send.call_args[0][2]['articles'][0]['title'], get_template('messages/help_title.html').render())
+
+    def wait_for_messages(self, api, count=1, timeout=5):
+        deadline = time.time() + timeout
+        while len(api.messages) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return api.messages
+
+    def test_late_reply_through_api(self):
+        # the whole production path: handler in the pool, budget missed, reply sent by the customer service API
+        original = HelpOrSubscribeHandler.handle
+        with mock.patch.object(settings, 'WECHAT_REPLY_BUDGET', 0.1), \
+                mock.patch.object(HelpOrSubscribeHandler, 'handle', lambda h: time.sleep(0.3) or original(h)), \
+                fake_wechat_api() as api:
+            resp = self.wechat_server.send_text('help', 'someone')
+            self.assertEqual(resp.content, b'success')
+            messages = self.wait_for_messages(api)
+            self.assertEqual(len(messages), 1)
+            self.assertEqual((messages[0]['touser'], messages[0]['msgtype']), ('someone', 'news'))
+            self.assertEqual(messages[0]['news']['articles'][0]['title'],
+                             get_template('messages/help_title.html').render())
+
+            resp = self.wechat_server.send_text('nothing matches this', 'someone')
+            self.assertEqual(self.wechat_server.get_msg_type(resp), 'text', 'in budget, replied passively')
+            self.assertEqual(len(api.messages), 1)
+
+    def test_async_budget(self):
+        original = HelpOrSubscribeHandler.handle
+        body = get_template('user_text.xml').render({
+            'ToUserName': '', 'FromUserName': 'someone', 'Content': 'help'
+        }).encode()
+        with mock.patch.object(settings, 'WECHAT_REPLY_BUDGET', 0.1), \
+                mock.patch.object(settings, 'IGNORE_WECHAT_SIGNATURE', True), \
+                fake_wechat_api() as api:
+            status, content = AsgiEndpointTest.call(CustomWeChatView.as_asgi(), 'POST', '/wechat', body=body)
+            self.assertEqual(ET.fromstring(content).find('MsgType').text, 'news')
+            with mock.patch.object(HelpOrSubscribeHandler, 'handle', lambda h: time.sleep(0.3) or original(h)):
+                status, content = AsgiEndpointTest.call(CustomWeChatView.as_asgi(), 'POST', '/wechat', body=body)
+                self.assertEqual(content, b'success')
+                asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.3))  # the server loop keeps running
+                messages = self.wait_for_messages(api)
+            self.assertEqual([m['msgtype'] for m in messages], ['news'])
+
+    def test_custom_message(self):
+        self.assertEqual(reply.custom_message(reply.text_reply('to', 'from', 'a < b')), ('text', {'content': 'a < b'}))
+        articles = reply.custom_message(reply.news_reply('to', 'from', [{'Title': 'T&T', 'Url': 'http://a/?x=1&y=2'}]))
+        self.assertEqual(articles[1]['articles'][0]['title'], 'T&T')
+        self.assertEqual(articles[1]['articles'][0]['url'], 'http://a/?x=1&y=2')
+        self.assertIsNone(reply.custom_message('success'))
+
+
+class MessageDedupTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.wechat_server = WechatTestClientLib()
+        patcher = mock.patch.object(settings, 'WECHAT_DEDUP_WINDOW', 60)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send_help(self, msg_id):
+        return self.wechat_server.post('/wechat', content_type='text/xml', data=(
+            '<xml><ToUserName><![CDATA[]]></ToUserName><FromUserName><![CDATA[someone]]></FromUserName>'
+            '<CreateTime>1500000000</CreateTime><MsgType><![CDATA[text]]></MsgType>'
+            '<Content><![CDATA[help]]></Content><MsgId>%s</MsgId></xml>' % msg_id
+        ))
+
+    def test_retry_not_handled_again(self):
+        with mock.patch.object(HelpOrSubscribeHandler, 'handle', autospec=True,
+                               side_effect=lambda handler: handler.reply_text('hi')) as handle:
+            first = self.send_help('6000000000000000001')
+            retry = self.send_help('6000000000000000001')
+            self.assertEqual(handle.call_count, 1)
+            self.assertEqual(retry.content, first.content)
+            self.send_help('6000000000000000002')
+            self.assertEqual(handle.call_count, 2)
+
+    def test_event_retry_not_handled_again(self):
+        subscribe = ('<xml><ToUserName><![CDATA[]]></ToUserName><FromUserName><![CDATA[someone]]></FromUserName>'
+                     '<CreateTime>1500000000</CreateTime><MsgType><![CDATA[event]]></MsgType>'
+                     '<Event><![CDATA[subscribe]]></Event></xml>')
+        with mock.patch.object(HelpOrSubscribeHandler, 'handle', autospec=True,
+                               side_effect=lambda handler: handler.reply_text('hi')) as handle:
+            for i in range(3):
+                self.wechat_server.post('/wechat', content_type='text/xml', data=subscribe)
+            self.assertEqual(handle.call_count, 1)
+
+    def test_check_dedup_cache(self):
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        memcached = {'default': {'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache'}}
+        with mock.patch.object(settings, 'CACHES', locmem):
+            self.assertFalse(CustomWeChatView.check_dedup_cache())
+            with mock.patch.object(settings, 'WECHAT_DEDUP_WINDOW', 0):
+                self.assertTrue(CustomWeChatView.check_dedup_cache())
+        with mock.patch.object(settings, 'CACHES', memcached):
+            self.assertTrue(CustomWeChatView.check_dedup_cache())
+
+    def test_retry_waits_for_original(self):
+        view = CustomWeChatView()
+        key = view.message_key({'FromUserName': 'someone', 'MsgType': 'event', 'Event': 'CLICK',
+                                'EventKey': 'k', 'CreateTime': '1500000000'})
+        self.assertTrue(view.claim_message(key))
+        self.assertFalse(view.claim_message(key))
+        threading.Timer(0.1, view.remember_reply, (key, 'reply')).start()
+        self.assertEqual(view.wait_for_reply(key), 'reply')
+
+    def test_event_key(self):
+        msg = {'FromUserName': 'someone', 'MsgType': 'event', 'Event': 'CLICK', 'EventKey': 'a', 'CreateTime': '1'}
+        self.assertNotEqual(CustomWeChatView.message_key(msg), CustomWeChatView.message_key(dict(msg, EventKey='b')))
+        self.assertIsNone(CustomWeChatView.message_key({'FromUserName': 'someone', 'MsgType': 'text'}))
+
+
+class WeChatLibHttpTest(TestCase):
+
+    def test_keep_alive(self):
+        lib = WeChatLib('', 'appid', 'secret')
+        with fake_wechat_api() as api:
+            lib.set_wechat_menu({'button': [{'name': 'menu'}]})
+            self.assertEqual(lib.get_wechat_menu(), [{'name': 'menu'}])
+            self.assertEqual(lib.get_wechat_menu(), [{'name': 'menu'}])
+            self.assertEqual(api.http.histogram.count(), 4, 'token is fetched once')
+            self.assertEqual(api.counts['connections'], 1, 'requests should share one connection')
+
+    def test_timeout(self):
+        with fake_wechat_api(latency=0.3, timeout=0.1) as api:
+            with self.assertRaises(OSError):
+                api.http.request('GET', api.url + '/cgi-bin/token')
+            api.latency = None
+            self.assertEqual(api.http.request('GET', api.url + '/cgi-bin/token')[0], 200)
+            snapshot = api.http.histogram.snapshot()
+            self.assertEqual((snapshot['count'], snapshot['errors']), (2, 1))
+
+    def test_rejected_token_fetched_again(self):
+        with fake_wechat_api() as api:
+            CustomWeChatView.lib.send_custom_message('someone', 'text', {'content': 'hi'})
+            api.tokens.clear()  # e.g. another client of the account fetched a token
+            CustomWeChatView.lib.send_custom_message('someone', 'text', {'content': 'again'})
+            self.assertEqual([m['text']['content'] for m in api.messages], ['hi', 'again'])
+            self.assertEqual(api.counts['/cgi-bin/token'], 2)
+
+    def test_errors(self):
+        with fake_wechat_api(error_rate=1) as api:
+            with self.assertRaises(WeChatError):
+                CustomWeChatView.lib.get_wechat_access_token()
+            self.assertGreaterEqual(api.counts['errors'], 1)
+
+
+class FileTokenStoreTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'token.json')
+        self.fetched = []
+
+    def fetch(self, expires_in=7200):
+        time.sleep(0.05)
+        self.fetched.append(1)
+        return 'TOKEN%d' % len(self.fetched), expires_in
+
+    def store(self, fetch=None):
+        store = FileTokenStore(self.path, fetch or self.fetch)
+        store.refresher_pid = os.getpid()  # no background thread unless a test starts one
+        return store
+
+    def test_single_flight(self):
+        stores = [self.store() for _ in range(8)]  # like 8 processes sharing the file
+        tokens = []
+        threads = [threading.Thread(target=lambda s=s: tokens.append(s.get())) for s in stores]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual(set(tokens), {'TOKEN1'})
+
+    def test_invalidate_once(self):
+        first, second = self.store(), self.store()
+        self.assertEqual(first.get(), 'TOKEN1')
+        self.assertEqual(second.get(), 'TOKEN1')
+        self.assertEqual(first.invalidate('TOKEN1'), 'TOKEN2')
+        self.assertEqual(second.invalidate('TOKEN1'), 'TOKEN2', 'a token invalidated elsewhere is not fetched again')
+        self.assertEqual(len(self.fetched), 2)
+
+    def test_background_refresh(self):
+        store = FileTokenStore(self.path, lambda: self.fetch(expires_in=1), margin=0)
+        self.addCleanup(store.stop)
+        self.assertEqual(store.get(), 'TOKEN1')
+        deadline = time.time() + 5
+        while len(self.fetched) < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertGreaterEqual(len(self.fetched), 2, 'token should be renewed before it expires')
+        self.assertNotEqual(store.get(), 'TOKEN1')
+
+
+class MenuSyncTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.lib = mock.Mock()
+        self.lib.get_wechat_menu.return_value = [{'name': 'old'}]
+
+    def test_push_on_change(self):
+        sync = MenuSync(self.lib, 0)
+        self.assertEqual(sync.current(), {'button': [{'name': 'old'}]})
+        self.assertTrue(sync.update({'button': [{'name': 'a'}]}))
+        self.assertFalse(sync.update({'button': [{'name': 'a'}]}))
+        self.assertEqual(self.lib.set_wechat_menu.call_count, 1)
+        self.assertEqual(sync.current(), {'button': [{'name': 'a'}]})
+        self.assertEqual(self.lib.get_wechat_menu.call_count, 1)
+
+    def test_debounce(self):
+        sync = MenuSync(self.lib, 0.1)
+        pushed = threading.Event()
+        self.lib.set_wechat_menu.side_effect = lambda menu: pushed.set()
+        for name in ('a', 'b', 'c'):
+            self.assertFalse(sync.update({'button': [{'name': name}]}))
+        self.assertEqual(sync.current(), {'button': [{'name': 'c'}]}, 'pending menu should be answered at once')
+        self.assertTrue(pushed.wait(5))
+        time.sleep(0.2)
+        self.lib.set_wechat_menu.assert_called_once_with({'button': [{'name': 'c'}]})
+
+    def test_diff(self):
+        self.assertEqual(MenuSync.diff(
+            {'button': [{'name': '抢票', 'sub_button': [{'name': 'x'}, {'name': 'y'}]}]},
+            {'button': [{'name': '抢票', 'sub_button': [{'name': 'y'}, {'name': 'z'}]}]},
+        ), ['-抢票/x', '+抢票/z'])
+
+
+class ActivityStatisticsTest(WechatBaseTest):
+
+    def test_counted_by_transitions(self):
+        act = self.activity_map['7e']
+        Ticket.allocate_pool(act)
+        first = Ticket.book_ticket('2016012345', act)
+        Ticket.book_tickets(['2018000000', '2018000001'], act)
+        Ticket.cancel_ticket(first, act)
+        counter_act = self.activity_map['8d']
+        Ticket.book_ticket('2016012345', counter_act)
+        for activity in (act, counter_act):
+            self.assertEqual(ActivityStatistics.get_for(activity.id), ActivityStatistics.count_tickets(activity.id))
+        self.assertEqual(ActivityStatistics.get_for(act.id), {'booked': 3, 'cancelled': 1, 'used': 0})
+
+    def test_reconcile(self):
+        act = self.activity_map['7e']
+        Ticket.create_ticket('2016012345', act)
+        Ticket.objects.filter(activity=act).update(status=Ticket.STATUS_USED)  # not counted
+        call_command('reconcilestats', str(act.id))
+        self.assertEqual(ActivityStatistics.get_for(act.id), {'booked': 1, 'cancelled': 0, 'used': 1})
+        self.assertEqual(ActivityStatistics.reconcile(act.id), {})
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+
+__author__ = "Epsirom"
+
+
+class FileTokenStore(object):
+    """
+    Access token shared by the processes on the host through a JSON file.
+    Refreshing happens under an exclusive flock on path + '.lock' and re-reads the file first,
+    so that one token is fetched no matter how many threads or processes find it stale.
+    A background thread renews the token refresh_ahead seconds before it expires, requests only read it.
+    """
+    logger = logging.getLogger('wechatlib')
+
+    def __init__(self, path, fetch, refresh_ahead=600, margin=60, retry_interval=10):
+        """
+        :param fetch: callable returning (access_token, expires_in seconds)
+        :param margin: a token expiring in margin seconds is not handed out any more
+        """
+        self.path = path
+        self.fetch = fetch
+        self.refresh_ahead = refresh_ahead
+        self.margin = margin
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.record = None
+        self.refresher = None
+        self.refresher_pid = None
+        self.stopped = threading.Event()
+
+    def read(self):
+        """
+        :return: dict of access_token, expires_at and refresh_at in time.time(), None if nothing is stored
+        """
+        try:
+            with open(self.path) as f:
+                record = json.load(f)
+            if {'access_token', 'expires_at', 'refresh_at'} <= set(record):
+                return record
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def write(self, record):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, self.path)
+
+    def usable(self, record, now):
+        return record is not None and now < record['expires_at'] - self.margin
+
+    def get(self):
+        self.start_refresher()
+        now = time.time()
+        record = self.record
+        if not self.usable(record, now):
+            record = self.read()  # renewed by another process
+            if self.usable(record, now):
+                self.record = record
+            else:
+                record = self.refresh()
+        return record['access_token']
+
+    def refresh(self, stale=None, ahead=False):
+        """
+        Fetch a new token unless the stored one is good: not stale (e.g. rejected by WeChat),
+        and not due for refresh (ahead) or not expiring (otherwise)
+        :return: the stored record
+        """
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    now = time.time()
+                    record = self.read()
+                    if record is not None and record['access_token'] != stale and (
+                            now < record['refresh_at'] if ahead else self.usable(record, now)):
+                        self.record = record
+                        return record
+                    access_token, expires_in = self.fetch()
+                    now = time.time()
+                    record = {
+                        'access_token': access_token,
+                        'expires_at': now + expires_in,
+                        'refresh_at': now + max(expires_in - self.refresh_ahead, expires_in / 2),
+                    }
+                    self.write(record)
+                    self.record = record
+                    self.logger.info('Got access token expiring in %d seconds', expires_in)
+                    return record
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def invalidate(self, access_token):
+        """
+        Called when WeChat rejects access_token, the token is fetched again once for all callers
+        """
+        return self.refresh(stale=access_token)['access_token']
+
+    def start_refresher(self):
+        if self.refresher_pid == os.getpid():
+            return
+        with self.lock:
+            if self.refresher_pid == os.getpid():
+                return
+            self.refresher = threading.Thread(target=self.run_refresher, name='token-refresher', daemon=True)
+            self.refresher_pid = os.getpid()  # threads do not survive fork, start again in a child process
+            self.refresher.start()
+
+    def run_refresher(self):
+        while not self.stopped.is_set():
+            record = self.read() or self.record
+            wait = record['refresh_at'] - time.time() if record is not None else 0
+            if wait <= 0:
+                try:
+                    self.refresh(ahead=True)
+                    continue
+                except Exception:
+                    self.logger.exception('Failed to refresh access token, retry in %d seconds', self.retry_interval)
+                    wait = self.retry_interval
+            self.stopped.wait(wait)
+
+    def stop(self):
+        self.stopped.set()
@@ -3,15 +3,20 @@ from django.utils import timezone
 from wechat.wrapper import WeChatView, WeChatLib
 from wechat.handlers import *
 from wechat.models import Activity
-from WeChatTicket.settings import WECHAT_TOKEN, WECHAT_APPID, WECHAT_SECRET
+from wechat.coordinator import BookingCoordinator
+from wechat.menusync import MenuSync
+from WeChatTicket.settings import WECHAT_TOKEN, WECHAT_APPID, WECHAT_SECRET, BOOKING_BATCH_WINDOW, \
+    WECHAT_MENU_DEBOUNCE
 
 
 class CustomWeChatView(WeChatView):
     lib = WeChatLib(WECHAT_TOKEN, WECHAT_APPID, WECHAT_SECRET)
+    booking = BookingCoordinator(BOOKING_BATCH_WINDOW)
+    menu_sync = MenuSync(lib, WECHAT_MENU_DEBOUNCE)
 
     handlers = [
         HelpOrSubscribeHandler, UnbindOrUnsubscribeHandler, BindAccountHandler, BookEmptyHandler, SnapUpTicketHandler,
-        CancelTicketHandler, WithdrawTicketHandler, BookWhatHandler, LookUpTicketHandler,
+        CancelTicketHandler, JoinWaitlistHandler, WithdrawTicketHandler, BookWhatHandler, LookUpTicketHandler,
     ]
     error_message_handler = ErrorHandler
     default_handler = DefaultHandler
@@ -91,7 +96,7 @@ class CustomWeChatView(WeChatView):
                 cls.logger.warn('Custom menu with %d activities, keep only 5', len(activities))
             cls.update_book_button([{'id': act.id, 'name': act.name} for act in activities[:5]])
         else:
-            current_menu = cls.lib.get_wechat_menu()
+            current_menu = cls.menu_sync.current().get('button', list())
             existed_buttons = list()
             for btn in current_menu:
                 if btn['name'] == '抢票':
@@ -107,4 +112,4 @@ class CustomWeChatView(WeChatView):
             return cls.update_menu(Activity.objects.filter(
                 id__in=activity_ids, status=Activity.STATUS_PUBLISHED, book_end__gt=timezone.now()
             ).order_by('book_end')[: 5])
-        cls.lib.set_wechat_menu(cls.menu)
+        cls.menu_sync.update(cls.menu)
@@ -1,18 +1,28 @@
 # -*- coding: utf-8 -*-
 #
-import datetime
+import asyncio
+import functools
 import hashlib
 import json
 import logging
-import urllib.request
+import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from WeChatTicket.settings import WECHAT_TOKEN, WECHAT_APPID, WECHAT_SECRET
 
+from django.core.cache import cache
+from django.db import close_old_connections
 from django.http import Http404, HttpResponse
 from django.template.loader import get_template
+from django.utils.functional import SimpleLazyObject
 
 from WeChatTicket import settings
+from codex import asgi
 from codex.baseview import BaseView
+from codex.httpclient import HttpClient
+from wechat import reply
+from wechat.messages import catalogue
+from wechat.tokenstore import FileTokenStore
 from wechat.models import User
 
 __author__ = "Epsirom"
@@ -21,6 +31,22 @@ __author__ = "Epsirom"
 class WeChatHandler(object):
     logger = logging.getLogger('WeChat')
 
+    # What the handler matches, compiled into the routing table of WeChatView.
+    # click_keys and click_key_prefixes are names in WeChatView.event_keys.
+    # Handlers overriding check() are tried in order as custom predicates instead.
+    msg_types = ()
+    events = ()
+    click_keys = ()
+    click_key_prefixes = ()
+    commands = ()
+    texts = ()
+
+    # WeChat shows at most 8 articles in a news reply
+    article_limit = 8
+
+    # handle() may touch the database, so the async endpoint runs it in the thread pool of the view
+    blocking = True
+
     def __init__(self, view, msg, user):
         """
         :type view: WeChatView
@@ -28,15 +54,36 @@ class WeChatHandler(object):
         :type user: User or None
         """
         self.input = msg
-        self.user = user
+        self._user = user
         self.view = view
 
+    @property
+    def user(self):
+        """
+        Loaded on first use, so that messages not involving the user cost no query
+        """
+        if self._user is None:
+            self._user = self.view.load_user(self.input)
+        return self._user
+
+    @user.setter
+    def user(self, user):
+        self._user = user
+
     def check(self):
-        raise NotImplementedError('You should implement check() in sub-class of WeChatHandler')
+        return self.input.get('MsgType') in self.msg_types or self.is_text(*self.texts) or \
+               self.is_text_command(*self.commands) or self.is_event(*self.events) or \
+               self.is_event_click(*[self.view.event_keys[k] for k in self.click_keys]) or \
+               self.is_event_click_startswith(*[self.view.event_keys[k] for k in self.click_key_prefixes])
 
     def handle(self):
         raise NotImplementedError('You should implement handle() in sub-class of WeChatHandler')
 
+    async def handle_async(self):
+        if not self.blocking:
+            return self.handle()
+        return await self.view.run_blocking(self.handle)
+
     def get_context(self, **extras):
         return dict(
             FromUserName=self.input['ToUserName'],
@@ -45,26 +92,28 @@ class WeChatHandler(object):
         )
 
     def reply_text(self, content):
-        return get_template('text.xml').render(self.get_context(
-            Content=content
-        ))
+        if settings.WECHAT_REPLY_TEMPLATES:
+            return get_template('text.xml').render(self.get_context(
+                Content=content
+            ))
+        return reply.text_reply(self.input['FromUserName'], self.input['ToUserName'], content)
 
     def reply_news(self, articles):
-        article_limit = 8
+        article_limit = self.article_limit
         if len(articles) > article_limit:
             self.logger.warn('Reply with %d articles, keep only %d', len(articles), article_limit)
-        return get_template('news.xml').render(self.get_context(
-            Articles=articles[:article_limit]
-        ))
+        if settings.WECHAT_REPLY_TEMPLATES:
+            return get_template('news.xml').render(self.get_context(
+                Articles=articles[:article_limit]
+            ))
+        return reply.news_reply(self.input['FromUserName'], self.input['ToUserName'], articles[:article_limit])
 
     def reply_single_news(self, article):
         return self.reply_news([article])
 
     def get_message(self, name, **data):
-        if name.endswith('.html'):
-            name = name[: -5]
-        return get_template('messages/' + name + '.html').render(dict(
-            handler=self, user=self.user, **data
+        return catalogue.render(name, data, dict(
+            handler=self, user=SimpleLazyObject(lambda: self.user)
         ))
 
     def is_msg_type(self, check_type):
@@ -76,6 +125,10 @@ class WeChatHandler(object):
     def is_event_click(self, *event_keys):
         return self.is_msg_type('event') and (self.input['Event'] == 'CLICK') and (self.input['EventKey'] in event_keys)
 
+    def is_event_click_startswith(self, *event_keys):
+        return self.is_msg_type('event') and (self.input['Event'] == 'CLICK') and any(
+            self.input['EventKey'].startswith(event_key) for event_key in event_keys)
+
     def is_event(self, *events):
         return self.is_msg_type('event') and (self.input['Event'] in events)
 
@@ -89,7 +142,7 @@ class WeChatHandler(object):
         return settings.get_url('u/bind', {'openid': self.user.open_id})
 
     def url_ticket_detail(self, ticket):
-        return settings.get_url('u/ticket', {'openid': self.user.open_id, 'ticket': ticket.unique_id})
+        return settings.get_url('u/ticket', {'openid': self.user.open_id, 'ticket': ticket.issue_token()})
 
     @staticmethod
     def url_activity_detail(activity):
@@ -106,6 +159,7 @@ class WeChatHandler(object):
 
 
 class WeChatEmptyHandler(WeChatHandler):
+    blocking = False
 
     def check(self):
         return True
@@ -127,11 +181,15 @@ class WeChatError(Exception):
 
 class WeChatLib(object):
     logger = logging.getLogger('wechatlib')
-    access_token = ''
-    access_token_expire = datetime.datetime.fromtimestamp(0)
     token = WECHAT_TOKEN
     appid = WECHAT_APPID
     secret = WECHAT_SECRET
+    api_root = settings.WECHAT_API_ROOT
+    http = HttpClient(settings.WECHAT_API_CONNECTIONS, settings.WECHAT_API_TIMEOUT)
+    token_store = None  # FileTokenStore shared by processes, set below
+
+    # invalid credential, invalid access token, access token expired
+    invalid_token_errcodes = (40001, 40014, 42001)
 
     def __init__(self, token, appid, secret):
         super(WeChatLib, self).__init__()
@@ -145,63 +203,92 @@ class WeChatLib(object):
         return tmpstr == signature
 
     @classmethod
-    def _http_get(cls, url):
-        req = urllib.request.Request(url=url)
-        res_data = urllib.request.urlopen(req)
-        res = res_data.read()
+    def _http_request(cls, method, url, data=None):
+        status, res = cls.http.request(method, url, data)
+        if status != 200:
+            raise WeChatError(-1, 'HTTP %d from %s' % (status, url.split('?', 1)[0]))
         return res.decode()
 
+    @classmethod
+    def _http_get(cls, url):
+        return cls._http_request('GET', url)
+
     @classmethod
     def _http_post(cls, url, data):
-        req = urllib.request.Request(
-            url=url, data=data if isinstance(data, bytes) else data.encode()
-        )
-        res_data = urllib.request.urlopen(req)
-        res = res_data.read()
-        return res.decode()
+        return cls._http_request('POST', url, data)
 
     @classmethod
     def _http_post_dict(cls, url, data):
         return cls._http_post(url, json.dumps(data, ensure_ascii=False))
 
     @classmethod
-    def get_wechat_access_token(cls):
-        if datetime.datetime.now() >= cls.access_token_expire:
-            print("appid=%s secret=%s" % (cls.appid, cls.secret))
-            res = cls._http_get(
-                'https://api.weixin.qq.com/cgi-bin/token?grant_type=client_credential&appid=%s&secret=%s' % (
-                    cls.appid, cls.secret
-                )
-            )
-            rjson = json.loads(res)
-            if rjson.get('errcode'):
-                raise WeChatError(rjson['errcode'], rjson['errmsg'])
-            cls.access_token = rjson['access_token']
-            cls.access_token_expire = datetime.datetime.now() + datetime.timedelta(seconds=rjson['expires_in'] - 300)
-            cls.logger.info('Got access token %s', cls.access_token)
-        return cls.access_token
-
-    def get_wechat_menu(self):
-        res = self._http_get(
-            'https://api.weixin.qq.com/cgi-bin/menu/get?access_token=%s' % (
-                self.get_wechat_access_token()
+    def fetch_access_token(cls):
+        """
+        :return: (access_token, expires_in)
+        """
+        res = cls._http_get(
+            cls.api_root + '/cgi-bin/token?grant_type=client_credential&appid=%s&secret=%s' % (
+                cls.appid, cls.secret
             )
         )
         rjson = json.loads(res)
+        if rjson.get('errcode'):
+            raise WeChatError(rjson['errcode'], rjson['errmsg'])
+        return rjson['access_token'], rjson['expires_in']
+
+    @classmethod
+    def get_wechat_access_token(cls):
+        return cls.token_store.get()
+
+    @classmethod
+    def _call_api(cls, path, data=None):
+        """
+        Call an API needing access token, fetching the token again once if WeChat says it is invalid or expired
+        :return: parsed JSON response
+        """
+        access_token = cls.get_wechat_access_token()
+        for retry in (True, False):
+            url = cls.api_root + path + ('&' if '?' in path else '?') + 'access_token=' + access_token
+            rjson = json.loads(cls._http_get(url) if data is None else cls._http_post_dict(url, data))
+            if rjson.get('errcode') in cls.invalid_token_errcodes and retry:
+                cls.logger.warn('Access token rejected with errcode %d, fetching again', rjson['errcode'])
+                access_token = cls.token_store.invalidate(access_token)
+                continue
+            return rjson
+
+    def get_wechat_menu(self):
+        rjson = self._call_api('/cgi-bin/menu/get')
         return rjson.get('menu', {}).get('button', [])
 
     def set_wechat_menu(self, data):
-        res = self._http_post_dict(
-            'https://api.weixin.qq.com/cgi-bin/menu/create?access_token=%s' % (
-                self.get_wechat_access_token()
-            ), data
-        )
-        rjson = json.loads(res)
+        rjson = self._call_api('/cgi-bin/menu/create', data)
         if rjson.get('errcode'):
             raise WeChatError(rjson['errcode'], rjson['errmsg'])
 
+    def send_custom_message(self, openid, msg_type, content):
+        """
+        Send a customer service message, e.g. send_custom_message(openid, 'text', {'content': 'hello'})
+        """
+        rjson = self._call_api('/cgi-bin/message/custom/send', {
+            'touser': openid,
+            'msgtype': msg_type,
+            msg_type: content,
+        })
+        if rjson.get('errcode'):
+            raise WeChatError(rjson['errcode'], rjson['errmsg'])
+
+
+WeChatLib.token_store = FileTokenStore(settings.WECHAT_TOKEN_FILE, WeChatLib.fetch_access_token)
+
+
+class WeChatViewMeta(type):
 
-class WeChatView(BaseView):
+    def __init__(cls, name, bases, attrs):
+        super(WeChatViewMeta, cls).__init__(name, bases, attrs)
+        cls.compile_routes()
+
+
+class WeChatView(BaseView, metaclass=WeChatViewMeta):
     logger = logging.getLogger('WeChat')
 
     lib = WeChatLib('', '', '')
@@ -210,12 +297,101 @@ class WeChatView(BaseView):
     error_message_handler = WeChatEmptyHandler
     default_handler = WeChatEmptyHandler
 
+    event_keys = {}
+
+    # threads running blocking handlers for the async endpoint and the reply budget,
+    # which also bounds their database connections
+    executor = ThreadPoolExecutor(settings.ASYNC_WORKERS)
+
+    # passive reply telling WeChat that no reply will follow, so that it does not retry
+    empty_reply = 'success'
+
+    # a retried message waits this long for the reply of the original, polling the cache every duplicate_poll
+    duplicate_wait = 4.5
+    duplicate_poll = 0.05
+
+    # cache backends whose add() is atomic across processes and hosts, which claim_message relies on
+    dedup_cache_backends = (
+        'django.core.cache.backends.memcached.MemcachedCache',
+        'django.core.cache.backends.memcached.PyLibMCCache',
+        'django.core.cache.backends.db.DatabaseCache',
+        'django_redis.cache.RedisCache',
+    )
+
+    @classmethod
+    def compile_routes(cls):
+        """
+        Index handlers by what they declare to match, so that a message is routed with dict lookups.
+        routes: (field, value) -> handler indexes, route_prefixes: prefix length -> {prefix: handler indexes}
+        """
+        cls.routes = dict()
+        cls.route_prefixes = dict()
+        cls.route_fallbacks = list()
+        for idx, handler in enumerate(cls.handlers):
+            if handler.check is not WeChatHandler.check:
+                cls.route_fallbacks.append(idx)
+                continue
+            keys = [('msg_type', x) for x in handler.msg_types] + [('event', x) for x in handler.events] + \
+                   [('click', cls.event_keys[x]) for x in handler.click_keys] + \
+                   [('command', x) for x in handler.commands] + [('text', x) for x in handler.texts]
+            for key in keys:
+                cls.routes.setdefault(key, list()).append(idx)
+            for name in handler.click_key_prefixes:
+                prefix = cls.event_keys[name]
+                cls.route_prefixes.setdefault(len(prefix), dict()).setdefault(prefix, list()).append(idx)
+
+    @classmethod
+    def route_keys(cls, msg):
+        """
+        :return: routing keys of msg, EventKey of click events or None
+        """
+        msg_type = msg.get('MsgType')
+        keys = [('msg_type', msg_type)]
+        click_key = None
+        if msg_type == 'text':
+            content = msg.get('Content') or ''
+            keys.append(('text', content.lower()))
+            words = content.split()
+            if words:
+                keys.append(('command', words[0]))
+        elif msg_type == 'event':
+            keys.append(('event', msg.get('Event')))
+            if msg.get('Event') == 'CLICK':
+                click_key = msg.get('EventKey') or ''
+                keys.append(('click', click_key))
+        return keys, click_key
+
+    def route(self, msg, user):
+        """
+        :return: instance of the first handler matching msg, None if nothing matched
+        """
+        keys, click_key = self.route_keys(msg)
+        matched = set()
+        for key in keys:
+            matched.update(self.routes.get(key, ()))
+        if click_key is not None:
+            for length, prefixes in self.route_prefixes.items():
+                matched.update(prefixes.get(click_key[: length], ()))
+        for idx in sorted(matched.union(self.route_fallbacks)):
+            inst = self.handlers[idx](self, msg, user)
+            if idx in matched or inst.check():
+                return inst
+        return None
+
     def _check_signature(self):
-        query = self.request.GET
-        return self.lib.check_signature(query['signature'], query['timestamp'], query['nonce'])
+        return self.check_signature_query(self.request.GET)
+
+    @classmethod
+    def check_signature_query(cls, query):
+        if settings.IGNORE_WECHAT_SIGNATURE:
+            return True
+        try:
+            return cls.lib.check_signature(query['signature'], query['timestamp'], query['nonce'])
+        except KeyError:
+            return False
 
     def do_dispatch(self, *args, **kwargs):
-        if not settings.IGNORE_WECHAT_SIGNATURE and not self._check_signature():
+        if not self._check_signature():
             self.logger.error('Check WeChat signature failed')
             raise Http404()
         if self.request.method == 'GET':
@@ -229,18 +405,198 @@ class WeChatView(BaseView):
         msg = self.parse_msg_xml(ET.fromstring(self.request.body))
         if 'FromUserName' not in msg:
             return self.error_message_handler(self, msg, None).handle()
-        user, created = User.objects.get_or_create(open_id=msg['FromUserName'])
-        if created:
-            self.logger.info('New user: %s', user.open_id)
+        key = self.message_key(msg)
+        if key is not None and not self.claim_message(key):
+            return self.wait_for_reply(key)
         try:
-            for handler in self.handlers:
-                inst = handler(self, msg, user)
-                if inst.check():
-                    return inst.handle()
-            return self.default_handler(self, msg, user).handle()
+            inst = self.route(msg, None) or self.default_handler(self, msg, None)
+            result = self.reply_in_budget(msg, inst)
         except:
             self.logger.exception('Error occurred when handling WeChat message %s', msg)
-            return self.error_message_handler(self, msg, user).handle()
+            result = self.error_message_handler(self, msg, None).handle()
+        self.remember_reply(key, result)
+        return result
+
+    async def handle_wechat_msg_async(self, body):
+        """
+        Same as handle_wechat_msg, the event loop is only blocked by routing, database work runs in executor
+        """
+        msg = self.parse_msg_xml(ET.fromstring(body))
+        if 'FromUserName' not in msg:
+            return await self.error_message_handler(self, msg, None).handle_async()
+        key = self.message_key(msg)
+        if key is not None and not self.claim_message(key):
+            return await self.wait_for_reply_async(key)
+        try:
+            inst = self.route(msg, None) or self.default_handler(self, msg, None)
+            result = await self.reply_in_budget_async(msg, inst)
+        except:
+            self.logger.exception('Error occurred when handling WeChat message %s', msg)
+            result = await self.error_message_handler(self, msg, None).handle_async()
+        self.remember_reply(key, result)
+        return result
+
+    @staticmethod
+    def message_key(msg):
+        """
+        WeChat retries a message with the same MsgId, or the same sender and CreateTime for events
+        :return: cache key identifying msg, None if retries of msg cannot be told apart or deduplication is off
+        """
+        if not settings.WECHAT_DEDUP_WINDOW:
+            return None
+        if msg.get('MsgId'):
+            return 'wechat:msg:%s' % msg['MsgId']
+        if msg.get('MsgType') == 'event' and msg.get('CreateTime'):
+            return 'wechat:event:%s:%s:%s:%s' % (msg['FromUserName'], msg['CreateTime'], msg.get('Event'),
+                                                  msg.get('EventKey') or '')
+        return None
+
+    @classmethod
+    def check_dedup_cache(cls):
+        """
+        Warn when retries may be handled twice, for CACHES being local to a process (locmem) or checking add()
+        and writing in two steps (filebased)
+        :return: False if the cache cannot deduplicate messages across workers
+        """
+        backend = settings.CACHES['default']['BACKEND']
+        if settings.WECHAT_DEDUP_WINDOW and backend not in cls.dedup_cache_backends:
+            cls.logger.warning('WECHAT_DEDUP_WINDOW is set but %s may let two workers claim the same message, '
+                               'use memcached, redis or the database as CACHES', backend)
+            return False
+        return True
+
+    @staticmethod
+    def claim_message(key):
+        """
+        Mark the message in flight in the shared cache
+        :return: False if the message has been claimed, i.e. this is a retry
+        """
+        return cache.add(key, (False, None), settings.WECHAT_DEDUP_WINDOW)
+
+    @staticmethod
+    def remember_reply(key, result):
+        if key is not None:
+            cache.set(key, (True, result), settings.WECHAT_DEDUP_WINDOW)
+
+    def poll_reply(self, key):
+        """
+        :return: reply of the original message, None if it is still in flight
+        """
+        done, result = cache.get(key, (True, self.empty_reply))
+        return result if done else None
+
+    def wait_for_reply(self, key):
+        self.logger.info('Retried WeChat message %s, waiting for the original', key)
+        deadline = time.monotonic() + self.duplicate_wait
+        while True:
+            result = self.poll_reply(key)
+            if result is not None:
+                return result
+            if time.monotonic() >= deadline:
+                return self.empty_reply  # the original will reply on its own
+            time.sleep(self.duplicate_poll)
+
+    async def wait_for_reply_async(self, key):
+        self.logger.info('Retried WeChat message %s, waiting for the original', key)
+        deadline = time.monotonic() + self.duplicate_wait
+        while True:
+            result = self.poll_reply(key)
+            if result is not None:
+                return result
+            if time.monotonic() >= deadline:
+                return self.empty_reply  # the original will reply on its own
+            await asyncio.sleep(self.duplicate_poll)
+
+    def reply_in_budget(self, msg, inst):
+        """
+        WeChat waits 5 seconds for a passive reply and retries the message after that.
+        A blocking handler not done in WECHAT_REPLY_BUDGET seconds is left running: the message is answered
+        with empty_reply at once and the handler's reply is sent as a customer service message later.
+        """
+        budget = settings.WECHAT_REPLY_BUDGET
+        if not budget or not inst.blocking:
+            return inst.handle()
+        future = self.executor.submit(self.run_with_connection, inst.handle)
+        try:
+            return future.result(budget)
+        except FutureTimeoutError:
+            self.logger.warn('%s missed the reply budget, reply to %s later', type(inst).__name__, msg['FromUserName'])
+            future.add_done_callback(lambda f: self.executor.submit(self.reply_late, msg, f))
+            return self.empty_reply
+
+    async def reply_in_budget_async(self, msg, inst):
+        budget = settings.WECHAT_REPLY_BUDGET
+        if not budget or not inst.blocking:
+            return await inst.handle_async()
+        task = asyncio.ensure_future(inst.handle_async())
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), budget)
+        except asyncio.TimeoutError:
+            self.logger.warn('%s missed the reply budget, reply to %s later', type(inst).__name__, msg['FromUserName'])
+            task.add_done_callback(lambda f: self.executor.submit(self.reply_late, msg, f))
+            return self.empty_reply
+
+    def reply_late(self, msg, future):
+        """
+        Send the reply of a handler which missed the reply budget, future is done
+        """
+        try:
+            result = future.result()
+        except Exception:
+            self.logger.exception('Error occurred when handling WeChat message %s', msg)
+            result = self.error_message_handler(self, msg, None).handle()
+        message = reply.custom_message(result)
+        if message is None:
+            return
+        try:
+            self.lib.send_custom_message(msg['FromUserName'], *message)
+        except Exception:
+            self.logger.exception('Failed to send late reply to %s', msg['FromUserName'])
+
+    @classmethod
+    async def run_blocking(cls, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(
+            cls.executor, functools.partial(cls.run_with_connection, func, *args)
+        )
+
+    @staticmethod
+    def run_with_connection(func, *args):
+        """
+        Treat a call in the thread pool like a request: drop unusable connections before and after it
+        """
+        close_old_connections()
+        try:
+            return func(*args)
+        finally:
+            close_old_connections()
+
+    @classmethod
+    def as_asgi(cls):
+        """
+        ASGI application serving the view, a request only holds a thread while its handler is blocking
+        """
+        async def app(scope, receive, send):
+            request = await asgi.read_request(scope, receive)
+            if not cls.check_signature_query(request.GET):
+                cls.logger.error('Check WeChat signature failed')
+                return await asgi.send_response(send, 404, 'Not Found')
+            if request.method == 'GET':
+                return await asgi.send_response(send, 200, request.GET.get('echostr', ''))
+            elif request.method == 'POST':
+                return await asgi.send_response(send, 200, await cls().handle_wechat_msg_async(request.body),
+                                                'application/xml')
+            else:
+                return await asgi.send_response(send, 405, 'Method Not Allowed', headers=[(b'allow', b'GET, POST')])
+        return app
+
+    @classmethod
+    def load_user(cls, msg):
+        """
+        :return: User sending msg, None if the message has no sender
+        """
+        if 'FromUserName' not in msg:
+            return None
+        return User.get_or_create_cached(msg['FromUserName'])
 
     @classmethod
     def parse_msg_xml(cls, root_elem):
@@ -249,3 +605,6 @@ class WeChatView(BaseView):
             for child in root_elem:
                 msg[child.tag] = child.text
         return msg
+
+
+WeChatView.check_dedup_cache()